@@ -1,10 +1,12 @@
 import asyncio
 import csv
+import functools
 from itertools import islice, chain, repeat
 import json
 import math
 import os
 import random
+import traceback
 import yaml
 import csv
 import requests
@@ -16,7 +18,8 @@ from typing import Optional
 
 from modules.pymjsoul import mjsoul
 from modules.pymjsoul.channel import MajsoulChannel, GeneralMajsoulError
-from modules.pymjsoul.client import ContestManagerClient
+from modules.pymjsoul.client import ContestManagerClient, MajsoulClient
+from modules.pymjsoul.replay_cache import ReplayCache
 from modules.pymjsoul.proto.combined import lq_dhs_pb2 as lq_dhs
 
 TAG_MESSAGES = [
@@ -68,6 +71,18 @@ EMOJI_MAHJONG_TILE = '\U0001F004'
 EMOJI_RED_CIRCLE = '\U0001F534'
 EMOJI_GREEN_CIRCLE = '\U0001F7E2'
 
+# Lobby notifications arriving within this many seconds of each other are folded into one
+# list refresh, but a refresh is never put off for longer than the max delay.
+DEFAULT_LIST_REFRESH_DELAY = 2
+DEFAULT_LIST_REFRESH_MAX_DELAY = 10
+
+# Seconds to wait for NotifyContestGameStart after a table was created.
+GAME_START_TIMEOUT = 60
+
+# Fetched replays are kept on disk, up to this many bytes.
+REPLAY_CACHE_FOLDER = 'ext/NewScoreTracker/records/replays'
+REPLAY_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
 # A Player-like object which has nickname and account_ids set.
 class AI():
     def __init__(self):
@@ -85,8 +100,22 @@ class ContestManagerInterface(commands.Cog):
         if access_token is None:
             raise Exception("missing mahjong_soul_access_token in environment / config.env")
 
+        self.access_token = access_token
         self.client = ContestManagerClient(lq_dhs, access_token)
         self.contest = None
+
+        # contest id -> client managing a contest other than the main one, for score tracking
+        self.contest_clients = {}
+        self._contest_clients_lock = asyncio.Lock()
+
+        # contest id -> (post channel id, score post ids)
+        self.score_posts = {}
+
+        # Lobby session for fetching replays, opened on first use
+        self._replay_client = None
+        self._replay_client_lock = asyncio.Lock()
+        # hand statistics updates running in the background after a game ended
+        self._hand_stats_tasks = set()
         config_file = os.environ.get('contests_configuration', 'contests.yaml')
         if config_file is None or not os.path.exists(config_file):
             raise Exception(f'please provide a contest configuration in {config_file}')
@@ -102,11 +131,18 @@ class ContestManagerInterface(commands.Cog):
         self.main_channel_id = int(config_raw['contests'][0]['channel_id'])
 
         self.list_message = None
-        self.rules = None
 
-        self._started_event = None
+        # game uuid -> future resolved by NotifyContestGameStart, while tables are being launched
+        self._game_starts = {}
+        self._launching = 0
         self._create_game_lock = asyncio.Lock()
 
+        self.list_refresh_delay = config_raw.get('list_refresh_delay', DEFAULT_LIST_REFRESH_DELAY)
+        self.list_refresh_max_delay = config_raw.get('list_refresh_max_delay', DEFAULT_LIST_REFRESH_MAX_DELAY)
+        self._refresh_task = None
+        self._refresh_requested_at = None
+        self._refresh_deadline = None
+
     async def async_setup(self):
         "Perform launch setup steps to allow usability right after restarting."
         await self.connect()
@@ -116,17 +152,19 @@ class ContestManagerInterface(commands.Cog):
         for contest in self.contests.values():
             contest_posts = contest.get('posts', {})
             list_post_id = contest_posts.get('list')
-            self.score_post_ids = contest_posts.get('scores', [])
-            self.post_channel_id = contest_posts.get('channel_id')
+            score_post_ids = contest_posts.get('scores', [])
+            post_channel_id = contest_posts.get('channel_id')
 
-            if self.post_channel_id:
-                post_channel = self.bot.get_channel(self.post_channel_id)
+            if post_channel_id:
+                post_channel = self.bot.get_channel(post_channel_id)
             else:
                 raise Exception('need to set contests[].posts.channel_id to make new list and score posts')
 
-            if not self.score_post_ids:
-                self.score_post_ids = [(await post_channel.send(f'Score Post {n}')).id for n in range(5)]
-                print(f'New score posts created: {self.score_post_ids}')
+            if not score_post_ids:
+                score_post_ids = [(await post_channel.send(f'Score Post {n}')).id for n in range(5)]
+                print(f'New score posts created: {score_post_ids}')
+
+            self.score_posts[contest['contest_id']] = (post_channel_id, score_post_ids)
 
             if list_post_id:
                 self.list_message = await post_channel.fetch_message(list_post_id)
@@ -137,10 +175,11 @@ class ContestManagerInterface(commands.Cog):
 
         # relies on NewScoreTracker being loaded first
         ScoreTrackerCog = self.bot.get_cog('TournamentScoreTracker')
-        await ScoreTrackerCog.get_logs()
+        found = await ScoreTrackerCog.get_all_logs()
 
-        # update the scores post
-        await ScoreTrackerCog.update_score_posts(self.post_channel_id, self.score_post_ids)
+        # update the scores posts
+        for contest_id in found:
+            await self.update_score_posts(contest_id)
 
         # begin updating the list post now that self.list_message is set
         await self.refresh_message()
@@ -148,20 +187,91 @@ class ContestManagerInterface(commands.Cog):
     # Helpers for common tasks that can be either invoked by command or
     # automatically upon startup.
     async def manage_contest(self, contest_id):
-        res = await self.client.call('manageContest', unique_id=contest_id)
-        self.contest = res.contest
+        self.contest = await self.client.manage_contest(contest_id)
+
+        # The main client covers this contest now.
+        client = self.contest_clients.pop(contest_id, None)
+        if client is not None:
+            await client.close()
 
         # retrieving rules useful for score tracking
-        res = await self.client.call('fetchContestGameRule')
-        self.rules = res.game_rule_setting
+        await self.client.rules()
 
-    async def connect(self):
+    async def connect(self, client=None):
         servers = await mjsoul.get_contest_management_servers()
 
         if len(servers) == 0:
             raise Exception('No contest management servers found')
 
-        await self.client.connect(servers[0])
+        await (client or self.client).connect(servers[0])
+
+    async def contest_client(self, contest_id=None):
+        '''
+        Returns: a client managing the given contest, by default the main one.
+
+        Other contests get a session of their own, opened on first use, so their records
+        and rules can be fetched without moving the main client away from its lobby.
+        '''
+        if contest_id is None or contest_id == self.contest.unique_id:
+            return self.client
+
+        async with self._contest_clients_lock:
+            if contest_id not in self.contest_clients:
+                client = ContestManagerClient(lq_dhs, self.access_token)
+                await self.connect(client)
+                await client.login()
+                await client.manage_contest(contest_id)
+                await client.subscribe('NotifyContestGameEnd', functools.partial(self.on_contest_game_end, contest_id))
+                self.contest_clients[contest_id] = client
+
+        return self.contest_clients[contest_id]
+
+    async def replay_client(self):
+        '''
+        Returns: a client logged into a game lobby server, where replays are fetched from.
+        '''
+        async with self._replay_client_lock:
+            if self._replay_client is None:
+                servers = await mjsoul.get_recommended_servers()
+
+                if len(servers) == 0:
+                    raise Exception('No lobby servers found')
+
+                client = MajsoulClient(lq_dhs, self.access_token,
+                                       replay_cache=ReplayCache(REPLAY_CACHE_FOLDER, REPLAY_CACHE_MAX_BYTES))
+                await client.connect(servers[0])
+                await client.login()
+                self._replay_client = client
+
+        return self._replay_client
+
+    async def cog_unload(self):
+        for task in self._hand_stats_tasks:
+            task.cancel()
+
+        # Also saves the replay cache index, with the access times of recent cache hits.
+        if self._replay_client is not None:
+            await self._replay_client.close()
+
+    async def update_hand_stats(self, uuid):
+        ScoreTrackerCog = self.bot.get_cog('TournamentScoreTracker')
+
+        try:
+            await ScoreTrackerCog.update_hand_stats([uuid], create=False)
+        except Exception as e:
+            print(f'Failed to update hand stats for {uuid}: {e!r}')
+
+    async def update_score_posts(self, contest_id=None):
+        if contest_id is None:
+            contest_id = self.contest.unique_id
+
+        if contest_id not in self.score_posts:
+            return
+
+        post_channel_id, score_post_ids = self.score_posts[contest_id]
+
+        ScoreTrackerCog = self.bot.get_cog('TournamentScoreTracker')
+        await ScoreTrackerCog.update_score_posts(post_channel_id, score_post_ids, contest_id)
 
     async def login(self):
         await self.client.login()
@@ -234,10 +344,10 @@ class ContestManagerInterface(commands.Cog):
 
         embed.set_thumbnail(url='https://cdn.discordapp.com/attachments/740078597351538768/802301149427794020/ichihime-0.png')
 
-        res = await self.client.call('fetchContestGameRule')
-        rules = res.game_rule_setting
+        contest_rules = await self.client.rules()
+        rules = contest_rules.setting
 
-        embed.add_field(name='Game Type', value=ROUND_TYPES[res.game_rule_setting.round_type])
+        embed.add_field(name='Game Type', value=ROUND_TYPES[contest_rules.round_type])
         embed.add_field(name='Thinking Time', value=THINKING_TIMES[rules.thinking_type])
 
         if rules.dora_count == 0:
@@ -245,21 +355,15 @@ class ContestManagerInterface(commands.Cog):
         else:
             embed.add_field(name='Red Fives', value=rules.dora_count)
 
-        if res.game_rule_setting.use_detail_rule:
-            rules = res.game_rule_setting.detail_rule_v2.game_rule
+        if contest_rules.setting.use_detail_rule:
+            rules = contest_rules.setting.detail_rule_v2.game_rule
             #Starting Points
-            embed.add_field(name='Starting Points', value=rules.init_point)
-            if is_sanma(res.game_rule_setting.round_type):
-                #Uma Calculation
-                shunweima_1 = (int)(-1*(rules.shunweima_2 + rules.shunweima_3))
-                embed.add_field(name='Uma', value=f'{shunweima_1}/{rules.shunweima_2}/{rules.shunweima_3}')
-            else:
-                #Uma Calculation
-                shunweima_1 = (int)(-1*(rules.shunweima_2 + rules.shunweima_3 + rules.shunweima_4))
-                embed.add_field(name='Uma', value=f'{shunweima_1}/{rules.shunweima_2}/{rules.shunweima_3}/{rules.shunweima_4}')
+            embed.add_field(name='Starting Points', value=contest_rules.starting_points)
+            #Uma
+            embed.add_field(name='Uma', value='/'.join([str(u) for u in contest_rules.uma]))
             #Kuitan
-            if not is_sanma(res.game_rule_setting.round_type):
-                embed.add_field(name='Open Tanyao', value=res.game_rule_setting.shiduan)
+            if not contest_rules.sanma:
+                embed.add_field(name='Open Tanyao', value=contest_rules.setting.shiduan)
             #Agari Yame
             embed.add_field(name='Agari Yame', value=rules.have_helezhongju)
             #Busting On
@@ -324,7 +428,7 @@ class ContestManagerInterface(commands.Cog):
         # registered = {p.nickname for p in await self.client.contest_players}
 
         # table size depends on the game setting
-        if is_sanma(self.rules.round_type):
+        if (await self.client.rules()).sanma:
             table_size = 3
         else:
             table_size = 4
@@ -643,23 +747,22 @@ class ContestManagerInterface(commands.Cog):
         player_lookup = {p.nickname: p for p in players}
 
         # Allow the use of bots
-        player_lookup[''] = 0
+        player_lookup[''] = AI()
 
         if layout_set != queued_player_set:
             await discord_channel.send(f"Can't start without these players: {', '.join(list(layout_set - queued_player_set))}")
             return
 
-        for table in self.layout:
-            # This should work well because of the set comparison from earlier
-            player_table = [player_lookup[nick] for nick in table]
-            await self.create_game_helper(discord_channel, player_table)
+        # This should work well because of the set comparison from earlier
+        tables = [[player_lookup[nick] for nick in table] for table in self.layout]
+        await self.launch_tables(discord_channel, tables)
 
     async def random_assignment(self, discord_channel, withBots=False):
         # This no-op list comprehension turns a special protobuf field type into a list.
         players = [p for p in await self.client.active_players]
 
         # table size depends on the game setting
-        if is_sanma(self.rules.round_type):
+        if (await self.client.rules()).sanma:
             table_size = 3
         else:
             table_size = 4
@@ -674,11 +777,9 @@ class ContestManagerInterface(commands.Cog):
                 players.append(AI())
 
         random.shuffle(players)
-        tables = chunk(players, table_size)
+        tables = [table for table in chunk(players, table_size) if len(table) == table_size]
 
-        for table in tables:
-            if len(table) == table_size:
-                await self.create_game_helper(discord_channel, table)
+        await self.launch_tables(discord_channel, tables)
 
         await self.refresh_message()
 
@@ -688,19 +789,46 @@ class ContestManagerInterface(commands.Cog):
         await self.list_message.edit(content=list_display)
         return games, queued
 
-    async def create_game_helper(self, discord_channel, table):
+    async def launch_tables(self, discord_channel, tables):
+        '''
+        Creates all tables at once and reports on each one as its game starts or fails to.
+        '''
         async with self._create_game_lock:
-            self._started_event = asyncio.Event()
+            self._launching += 1
+            try:
+                await asyncio.gather(*[self.create_game_helper(discord_channel, table) for table in tables])
+            finally:
+                self._launching -= 1
+                if not self._launching:
+                    self._game_starts.clear()
+
+    async def create_game_helper(self, discord_channel, table):
+        nicknames = ' | '.join([p.nickname for p in table])
 
+        try:
             id_table = [p.account_id for p in table]
             game_uuid = await self.client.create_game(id_table)
-            await self._started_event.wait()
 
-            nicknames = ' | '.join([p.nickname for p in table])
-            await discord_channel.send(f"Battle starting for {nicknames}")
+            # The start notification may already be here, matched by uuid either way.
+            await asyncio.wait_for(self.game_start(game_uuid), timeout=GAME_START_TIMEOUT)
+        except asyncio.TimeoutError:
+            await discord_channel.send(f"Game created but didn't start for {nicknames}")
+            return
+        except Exception as e:
+            await discord_channel.send(f"Unable to start game for {nicknames}: {e}")
+            return
+
+        await discord_channel.send(f"Battle starting for {nicknames}")
+
+    def game_start(self, game_uuid):
+        if game_uuid not in self._game_starts:
+            self._game_starts[game_uuid] = asyncio.get_running_loop().create_future()
+
+        return self._game_starts[game_uuid]
 
-    async def locate_completed_game(self, game_uuid):
-        res = await self.client.call('fetchContestGameRecords')
+    async def locate_completed_game(self, game_uuid, contest_id=None):
+        client = await self.contest_client(contest_id)
+        res = await client.call('fetchContestGameRecords')
         for item in res.record_list:
             if item.record.uuid == game_uuid:
                 return item.record
@@ -716,11 +844,7 @@ class ContestManagerInterface(commands.Cog):
         # It takes some time for the results to register into the log
         await asyncio.sleep(5)
 
-        try:
-            record = await self.locate_completed_game(msg.game_uuid)
-        except Exception as e:
-            await self.login()
-            record = await self.locate_completed_game(msg.game_uuid)
+        record = await self.locate_completed_game(msg.game_uuid)
 
         response = None
 
@@ -754,7 +878,13 @@ class ContestManagerInterface(commands.Cog):
             games, queued = await self.client.display_players()
 
         # update the durable score post
-        await ScoreTrackerCog.update_score_posts(self.post_channel_id, self.score_post_ids)
+        await self.update_score_posts()
+
+        # Fetching the replay can take a while, and opens a lobby session the first time.
+        if record:
+            task = asyncio.create_task(self.update_hand_stats(record.uuid))
+            self._hand_stats_tasks.add(task)
+            task.add_done_callback(self._hand_stats_tasks.discard)
 
         # If a game ended, and we observe there are now 0 games,
         # and the contest has a ping, ping it!
@@ -765,45 +895,76 @@ class ContestManagerInterface(commands.Cog):
             msg = ' '.join([f'<@&{role_id}>' for role_id in notify_roles]) + ' ' + random.choice(TAG_MESSAGES)
             await channel.send(msg)
 
-    async def on_NotifyContestGameStart(self, _, msg):
-        if not self._started_event:
-            print(f'NotifyContestGameStart received but not waiting for a game!')
+    async def on_contest_game_end(self, contest_id, _, msg):
+        '''
+        Game end handler of the sessions managing other contests than the main one, which
+        only keeps their records and score posts up to date.
+        '''
+        await asyncio.sleep(5)
+
+        record = await self.locate_completed_game(msg.game_uuid, contest_id)
+        if not record:
+            print(f'An unknown game of contest {contest_id} concluded: {msg.game_uuid}')
             return
 
+        ScoreTrackerCog = self.bot.get_cog('TournamentScoreTracker')
+        await ScoreTrackerCog.record_multiple_games([record], contest_id)
+
+        await self.update_score_posts(contest_id)
+
+    async def on_NotifyContestGameStart(self, _, msg):
         nicknames = ' | '.join([p.nickname or 'Computer' for p in msg.game_info.players])
         self.active_games[msg.game_info.game_uuid] = nicknames
 
-        self._started_event.set()
-        self._started_event = None
+        if not self._launching:
+            print(f'NotifyContestGameStart received but not waiting for a game!')
+            return
+
+        started = self.game_start(msg.game_info.game_uuid)
+        if not started.done():
+            started.set_result(msg)
 
     async def on_NotifyContestMatchingPlayer(self, name, msg):
+        # People tend to press "Prepare for Match" all at once, so don't fetch
+        # the lobby and edit the list post for every single notification.
+        self.request_refresh()
 
-        prev_active = set([p.nickname for p in self.client._active_players])
-        prev_playing = set([p.nickname for g in self.client._ongoing_games for p in g.players])
-        PREV = prev_active #| prev_playing
+    def request_refresh(self):
+        '''
+        Schedules a lobby refresh. Requests are coalesced until list_refresh_delay seconds
+        pass without a new one, or list_refresh_max_delay seconds after the first one.
+        '''
+        now = asyncio.get_running_loop().time()
 
-        res = await self.client.call('startManageGame')
+        if self._refresh_requested_at is None:
+            self._refresh_requested_at = now
 
-        now_active = set([p.nickname for p in res.players])
-        now_playing = set([p.nickname for g in res.games for p in g.players])
-        NOW = now_active #| now_playing
+        self._refresh_deadline = min(now + self.list_refresh_delay,
+                                     self._refresh_requested_at + self.list_refresh_max_delay)
 
-        changes = PREV ^ NOW   #symmetric difference; elements in old or new, but not both
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.coalesced_refresh())
 
-        for player in changes:
-            if player in PREV:
-                #player left the lobby
-                '''
-                if player in prev_active:
-                    await self.main_channel.send(f"{player} left the lobby.")
-                '''
-            else:
-                #player joined the lobby
-                #await self.main_channel.send(f"{player} joined the lobby.")
-                pass
+    async def coalesced_refresh(self):
+        loop = asyncio.get_running_loop()
 
-        if self.list_message != None:
-            await self.refresh_message(res)
+        # Requests made while a refresh is in flight start another round.
+        while self._refresh_requested_at is not None:
+            delay = self._refresh_deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            self._refresh_requested_at = None
+
+            try:
+                if self.list_message != None:
+                    await self.refresh_message()
+                else:
+                    await self.client.display_players()
+            except Exception:
+                print('Lobby refresh failed:')
+                traceback.print_exc()
 
     def render_lobby_output(self, games, queued):
         if self.layout:
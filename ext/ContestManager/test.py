@@ -1,11 +1,34 @@
-from pymjsoul.client import ContestManager
 import asyncio
 
+from modules.pymjsoul.client import ContestManagerClient
+from modules.pymjsoul.proto.combined import lq_dhs_pb2 as lq_dhs
+from modules.pymjsoul.standin import StandinServer
+
+# Run from the repository root: python -m ext.ContestManager.test
 async def main():
-    import pymjsoul.proto.dhs.dhs_pb2 as dhs
-    client = ContestManager(dhs)
-    await client.login('e0719795-a8d8-4f91-91c6-c152126a7bb2')
-    print(client.contest_list)
+    contest = lq_dhs.ResManageContest()
+    contest.contest.unique_id = 123456
+    contest.contest.contest_name = 'Test Contest'
+
+    players = lq_dhs.ResFetchCustomizedContestPlayer()
+    players.players.add(account_id=1, nickname='player1')
+    players.players.add(account_id=2, nickname='player2')
+
+    responses = {
+        'oauth2LoginContestManager': lq_dhs.ResContestManageOauth2Login(),
+        'manageContest': contest,
+        'fetchContestPlayer': players,
+    }
+
+    async with StandinServer(lq_dhs, responses) as server:
+        client = ContestManagerClient(lq_dhs, 'access token')
+        await client.connect(server.uri)
+        await client.login()
+
+        print(await client.manage_contest(123456))
+        print(await client.contest_players)
+
+        await client.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -1,24 +1,33 @@
 import asyncio
+import hashlib
 from itertools import zip_longest
 from logging import exception
 import math
 import os
 import pandas as pd
-import pickle
 import pytz
 import unicodedata
 import json
 import yaml
 
+from contextlib import aclosing
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta, MO, FR
+from functools import partial
 
-from discord import app_commands, Embed, Interaction, Object, PartialMessage, PartialMessageable
+from discord import app_commands, Embed, HTTPException, Interaction, Object, PartialMessage, PartialMessageable
 from discord.ext import commands
 from typing import Optional
 
 from tabulate import tabulate
 
+from modules.pymjsoul.proto.combined import lq_dhs_pb2 as lq_dhs
+from modules.pymjsoul.replay import ReplayDecodeError
+
+from ext.NewScoreTracker.hand_stats import HandStatsTable
+from ext.NewScoreTracker.record_index import RecordIndex
+from ext.NewScoreTracker.store import GameRecordStore
+
 RECORDS_FOLDER = 'ext/NewScoreTracker/records'
 
 DEFAULT_RECORDS_NAME = 'log'
@@ -26,6 +35,31 @@ DEFAULT_RECORDS_NAME = 'log'
 # 2000 Minus extra characters for fixed formatting: ```\n$FOO\n```\n
 DISCORD_MAX_CHAR_LIMIT = 1990
 
+# Pages of game records fetched ahead while the previous ones are still being ingested
+LOG_PREFETCH_PAGES = 2
+
+# Contests whose game records are synced at the same time by get_all_logs
+MAX_CONCURRENT_CONTEST_SYNCS = 4
+
+# Seconds between score post edits, on top of discord.py's own rate limit handling,
+# and before retrying an edit that was rate limited anyway.
+SCORE_POST_EDIT_INTERVAL = 1
+SCORE_POST_RATE_LIMIT_BACKOFF = 10
+
+# Replays fetched at the same time when updating hand statistics
+MAX_CONCURRENT_REPLAY_FETCHES = 4
+
+# The leaderboard covering a contest's datetime filter
+SEASON_WINDOW = 'season'
+
+# Rolling leaderboards that can be listed under "leaderboard_windows" in config.json.
+# Each maps the start of today to the start and (exclusive) end of its current window.
+LEADERBOARD_WINDOWS = {
+    'daily': lambda today: (today, today + relativedelta(days=1)),
+    'weekly': lambda today: (today + relativedelta(weekday=MO(-1)), today + relativedelta(weekday=MO(-1), weeks=1)),
+    'monthly': lambda today: (today + relativedelta(day=1), today + relativedelta(day=1, months=1)),
+}
+
 
 class GameLogFilter():
     def __init__(self, datetime_start=datetime.min, datetime_end=datetime.max):
@@ -36,6 +70,21 @@ class GameLogFilter():
         return dt >= self.datetime_start and dt <= self.datetime_end
 
 
+class ContestScores():
+    '''
+    Game records and filter of one contest.
+    '''
+    def __init__(self, contest_id, game_log_filter):
+        self.contest_id = contest_id
+        self.game_log_filter = game_log_filter
+
+        # sanma -> RecordIndex of every stored game, which all standings are looked up in
+        self.record_indexes = {True: RecordIndex(3), False: RecordIndex(4)}
+
+        # HandStatsTable, built from replays once asked for
+        self.hand_stats = None
+
+
 class TournamentScoreTracker(commands.Cog):
     "Score Tracking"
     field_majsoul_name = 'Majsoul Name'
@@ -66,167 +115,199 @@ class TournamentScoreTracker(commands.Cog):
 
     json_config = None
 
-    def __init__(self, bot):
+    def __init__(self, bot, store=None):
         with open("ext/NewScoreTracker/config.json", "r") as f:
             self.json_config = json.loads(f.read())
 
+        unknown_windows = set(self.json_config.get('leaderboard_windows', [])) - set(LEADERBOARD_WINDOWS)
+        if unknown_windows:
+            raise Exception(f'unknown leaderboard_windows in ext/NewScoreTracker/config.json: {sorted(unknown_windows)}, '
+                            f'expected any of {list(LEADERBOARD_WINDOWS)}')
+
         self.bot = bot
 
-        self.SANMA_GAME_RECORDS = None
-        self.YONMA_GAME_RECORDS = None
+        pd.set_option("display.unicode.east_asian_width", True)
+
         self.game_records_lock = asyncio.Lock()
-        self.game_records_filename = None
+        self.game_records_filename = os.path.join(RECORDS_FOLDER, f'{DEFAULT_RECORDS_NAME}.sqlite3')
+        # The on-disk store under RECORDS_FOLDER unless another GameRecordStore is given.
+        self.store = store or GameRecordStore(self.game_records_filename)
 
-        # automatically determine filter start/end
-        now = datetime.now().replace(hour=0, minute=0)
-        first_day_date = (now + relativedelta(day=1))
-        last_day_date = (now + relativedelta(day=31))
-        self.game_log_filter = GameLogFilter(first_day_date, last_day_date)
+        # contest id -> ContestScores, loaded from the store on first use
+        self.contests = {}
         self.event_stop_log_search = asyncio.Event()
 
-        self.initialize_dataframe()
+        # post id -> digest of the content the post was last edited to
+        self.score_post_digests = {}
+        # post id -> (post channel id, content, embed, digest), applied in order by one task
+        self.pending_post_edits = {}
+        self._post_edit_task = None
+        # (post id, digest) of the edit being applied right now
+        self.post_edit_in_flight = None
 
-    def initialize_dataframe(self):
-        self.SANMA_GAME_RECORDS = pd.DataFrame(columns=self.sanma_game_record_fields)
-        self.SANMA_GAME_RECORDS = self.SANMA_GAME_RECORDS.set_index(
-            self.game_record_index, drop=False)
-        pd.set_option("display.unicode.east_asian_width", True)
+    def contest_scores(self, contest_id=None):
+        '''
+        Returns: the ContestScores of a contest, by default the one currently managed
+        '''
+        if contest_id is None:
+            contest_id = self.bot.get_cog('ContestManagerInterface').contest.unique_id
 
-        self.YONMA_GAME_RECORDS = pd.DataFrame(columns=self.yonma_game_record_fields)
-        self.YONMA_GAME_RECORDS = self.YONMA_GAME_RECORDS.set_index(
-            self.game_record_index, drop=False)
-        pd.set_option("display.unicode.east_asian_width", True)
+        if contest_id not in self.contests:
+            # automatically determine filter start/end
+            now = datetime.now().replace(hour=0, minute=0)
+            first_day_date = (now + relativedelta(day=1))
+            last_day_date = (now + relativedelta(day=31))
 
-    async def record_game(self, log):
-        if is_sanma(log.config.mode.mode):
-            records = self.SANMA_GAME_RECORDS
-            fields = self.sanma_game_record_fields
-        else:
-            records = self.YONMA_GAME_RECORDS
-            fields = self.yonma_game_record_fields
+            scores = ContestScores(contest_id, GameLogFilter(first_day_date, last_day_date))
+            self.load_records(scores)
 
-        if log.uuid in records.index:
-            print(f'Game {log.uuid} already recorded.')
-            return
+            self.contests[contest_id] = scores
 
-        points = [player.part_point_1 for player in log.result.players]
-        seats = [player.seat for player in log.result.players]
-        players = [log.accounts[s].nickname for s in seats if s <
-                   len(log.accounts)]
+        return self.contests[contest_id]
 
-        entry = [log.uuid, log.end_time, *players, *points]
+    def channel_contest_id(self, channel_id):
+        '''
+        Returns: id of the contest configured for a discord channel, None for the managed one
+        '''
+        ContestManager = self.bot.get_cog('ContestManagerInterface')
+        contest = ContestManager.contests.get(channel_id)
+        return contest['contest_id'] if contest else None
+
+    def load_records(self, scores):
+        '''
+        Indexes every stored game of the contest.
+        '''
+        for sanma, record_index in scores.record_indexes.items():
+            record_index.add_games(self.store.load(scores.contest_id, sanma))
 
-        game = pd.DataFrame(entry, columns=fields)
-        game = game.set_index(self.game_record_index, drop=False)
+        loaded = sum(len(record_index) for record_index in scores.record_indexes.values())
+        print(f'Loaded {loaded} stored games of contest {scores.contest_id} from {self.store.path}')
 
-        async with self.game_records_lock:
-            if is_sanma(log.config.mode.mode):
-                self.SANMA_GAME_RECORDS = self.SANMA_GAME_RECORDS.append(game)
-            else:
-                self.YONMA_GAME_RECORDS = self.YONMA_GAME_RECORDS.append(game)
+    def filter_timestamps(self, game_log_filter):
+        '''
+        Returns: the filter's start and end as unix timestamps, None where unbounded
+        '''
+        bounds = []
+        for dt in (game_log_filter.datetime_start, game_log_filter.datetime_end):
+            try:
+                bounds.append(int(dt.timestamp()))
+            except (ValueError, OverflowError, OSError):
+                # datetime.min / datetime.max
+                bounds.append(None)
+        return bounds
 
-        print(f"Recorded game {log.uuid}")
+    def leaderboard_windows(self, scores):
+        '''
+        Returns: leaderboard window name -> (start, end) unix timestamps for a contest, starting
+        with the season set by its filter, followed by the rolling windows from the config
+        '''
+        windows = {SEASON_WINDOW: tuple(self.filter_timestamps(scores.game_log_filter))}
 
-    async def record_multiple_games(self, logs):
-        if len(logs) == 0:
-            return
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        for name in self.json_config.get('leaderboard_windows', []):
+            start, end = LEADERBOARD_WINDOWS[name](today)
+            windows[name] = (int(start.timestamp()), int(end.timestamp()) - 1)
 
-        entries = []
-        for game_log in logs:
-            if is_sanma(game_log.config.mode.mode):
-                records = self.SANMA_GAME_RECORDS
-                fields = self.sanma_game_record_fields
-            else:
-                records = self.YONMA_GAME_RECORDS
-                fields = self.yonma_game_record_fields
+        return windows
 
-            if game_log.uuid in records.index:
-                print(f'Game {game_log.uuid} already recorded.')
-                return
+    def game_entry(self, game_log):
+        '''
+        Returns: whether the game is sanma, and its game record entry
+        '''
+        points = [player.part_point_1 for player in game_log.result.players]
+        seats = [player.seat for player in game_log.result.players]
+        players = [game_log.accounts[s].nickname for s in seats]
 
-            points = [player.part_point_1 for player in game_log.result.players]
-            seats = [player.seat for player in game_log.result.players]
-            players = [game_log.accounts[s].nickname for s in seats]
+        return is_sanma(game_log.config.mode.mode), [game_log.uuid, game_log.end_time, *players, *points]
 
-            entries.append(
-                [game_log.uuid, game_log.end_time, *players, *points])
+    def archive_games(self, contest_id, logs):
+        '''
+        Saves games of a contest to the record store, and to its record index if it is loaded.
+        '''
+        entries = {True: [], False: []}
+        for game_log in logs:
+            sanma, entry = self.game_entry(game_log)
+            entries[sanma].append(entry)
 
-        games = pd.DataFrame(entries, columns=fields)
-        games = games.set_index(self.game_record_index, drop=False)
+        for sanma, sanma_entries in entries.items():
+            if sanma_entries:
+                self.store.add_games(contest_id, sanma, sanma_entries)
 
-        async with self.game_records_lock:
-            if is_sanma(game_log.config.mode.mode):
-                self.SANMA_GAME_RECORDS = self.SANMA_GAME_RECORDS.append(games)
-            else:
-                self.YONMA_GAME_RECORDS = self.YONMA_GAME_RECORDS.append(games)
+                if contest_id in self.contests:
+                    self.contests[contest_id].record_indexes[sanma].add_games(sanma_entries)
 
-    async def create_score_table(self, starting_points, return_points, uma, sanma=False, custom_filter=None):
-        '''
-        Processes all the stored game logs
+    async def record_game(self, log, contest_id=None):
+        if await self.record_multiple_games([log], contest_id):
+            print(f"Recorded game {log.uuid}")
 
-        Returns: A score table that displays cumulative and average scores for each player
-        Return Type: Pandas DataFrame
+    async def record_multiple_games(self, logs, contest_id=None):
+        '''
+        Returns: number of games recorded, leaving out the ones that already were
         '''
+        if len(logs) == 0:
+            return 0
 
-        df = pd.DataFrame(columns=self.score_table_fields)
-        df = df.set_index(self.score_table_index, drop=False)
+        scores = self.contest_scores(contest_id)
 
-        async with self.game_records_lock:
-            if sanma:
-                records = self.SANMA_GAME_RECORDS
-            else:
-                records = self.YONMA_GAME_RECORDS
+        new_logs = []
+        for game_log in logs:
+            if game_log.uuid in scores.record_indexes[is_sanma(game_log.config.mode.mode)]:
+                print(f'Game {game_log.uuid} already recorded.')
+                continue
 
-            for index, row in records.iterrows():
-                end_time = datetime.fromtimestamp(row.loc[self.field_game_end_time])
-                if not custom_filter or custom_filter.match(end_time):
-                    df = await self.update_score_table(df, records, index, starting_points, return_points, uma, sanma, custom_filter)
+            new_logs.append(game_log)
+
+        async with self.game_records_lock:
+            self.archive_games(scores.contest_id, new_logs)
 
-        return df
+        return len(new_logs)
 
-    async def update_score_table(self, df, records, index, starting_points, return_points, uma, sanma, custom_filter):
+    async def create_score_table(self, starting_points, return_points, uma, sanma=False, custom_filter=None, contest_id=None, window=SEASON_WINDOW):
         '''
-        Updates the score table with a game record
+        Looks up the standings of a contest, by default the one currently managed, over one of
+        its leaderboard windows, or over the range of custom_filter if one is passed.
+
+        Standings come from the contest's record index, which scores every game once per set
+        of rules, so any window or range is a slice of it rather than a pass over the records.
+
+        Returns: A score table that displays cumulative and average scores for each player
+        Return Type: Pandas DataFrame
         '''
-        if sanma:
-            name_fields = self.sanma_player_name_fields
-            point_fields = self.sanma_player_point_fields
+        rules = (starting_points, return_points, tuple(uma))
+
+        scores = self.contest_scores(contest_id)
+
+        if custom_filter:
+            start, end = self.filter_timestamps(custom_filter)
         else:
-            name_fields = self.yonma_player_name_fields
-            point_fields = self.yonma_player_point_fields
+            start, end = self.leaderboard_windows(scores)[window]
+
+        score_batch = partial(self.calculate_scores_batch, starting_points, return_points, uma)
 
-        PLAYERS = [records.loc[index, n] for n in name_fields]
-        POINTS = [records.loc[index, s] for s in point_fields]
+        async with self.game_records_lock:
+            rows = scores.record_indexes[sanma].standings(rules, score_batch, start, end)
 
-        assert(len(PLAYERS) == len(POINTS))
+        df = pd.DataFrame(rows, columns=self.score_table_fields)
+        return df.set_index(self.score_table_index, drop=False)
 
+    def calculate_scores(self, starting_points, return_points, uma, points):
         ScoreCalculator = self.bot.get_cog('ScoreCalculator')
         if self.json_config["use_floating_uma"]:
-            SCORES = ScoreCalculator.calculate_scores(
-                POINTS, starting_points, return_points, uma, use_floating_uma=True, floating_uma_one=self.json_config["floating_uma_one"], floating_uma_two=self.json_config["floating_uma_two"], floating_uma_three=self.json_config["floating_uma_three"])
+            return ScoreCalculator.calculate_scores(
+                points, starting_points, return_points, uma, use_floating_uma=True, floating_uma_one=self.json_config["floating_uma_one"], floating_uma_two=self.json_config["floating_uma_two"], floating_uma_three=self.json_config["floating_uma_three"])
         else:
-            SCORES = ScoreCalculator.calculate_scores(
-                POINTS, starting_points, return_points, uma)
-
-        for i in range(0, len(PLAYERS)):
-            name = PLAYERS[i]
-            score = SCORES[i]
-            placement = i+1
-
-            if name not in df[self.score_table_index]:
-                new_player = pd.DataFrame(
-                    [[name, *[0]*7]], columns=self.score_table_fields)
-                new_player = new_player.set_index(
-                    self.score_table_index, drop=False)
-                df = df.append(new_player)
+            return ScoreCalculator.calculate_scores(
+                points, starting_points, return_points, uma)
 
-            df.loc[name, self.field_matches_played] += 1
-            df.loc[name, self.field_total_score] += score
-            df.loc[name, self.field_average_score] = df.loc[name,
-                                                            self.field_total_score] / df.loc[name, self.field_matches_played]
-            df.loc[name, f'{placement}'] += 1
+    def calculate_scores_batch(self, starting_points, return_points, uma, points):
+        '''
+        Scores every row of a (games x seats) array of points in one pass.
+        '''
+        if self.json_config["use_floating_uma"]:
+            return [self.calculate_scores(starting_points, return_points, uma, p) for p in points]
 
-        return df
+        ScoreCalculator = self.bot.get_cog('ScoreCalculator')
+        return ScoreCalculator.calculate_scores_batch(points, starting_points, return_points, uma)
 
 
     async def convert_to_embed(self, df, fields):
@@ -258,7 +339,10 @@ class TournamentScoreTracker(commands.Cog):
             except ValueError as e:
                 datetime_end = datetime.max
 
-        self.game_log_filter = GameLogFilter(datetime_start, datetime_end)
+        scores = self.contest_scores(self.channel_contest_id(interaction.channel_id))
+
+        # Every stored game is indexed, so the new range is looked up as far as it was synced.
+        scores.game_log_filter = GameLogFilter(datetime_start, datetime_end)
 
         await interaction.followup.send(f"{datetime_start.isoformat()} to {datetime_end.isoformat()}")
 
@@ -268,53 +352,257 @@ class TournamentScoreTracker(commands.Cog):
         self.event_stop_log_search.set()
         await interaction.followup.send('Stopped search')
 
+    @app_commands.command(name='scores-between', description='Shows scores between two times without changing the filter')
+    @app_commands.describe(start="(optional) Start time")
+    @app_commands.describe(end="(optional) End time")
+    async def command_scores_between(self, interaction : Interaction, start : Optional[str], end : Optional[str]):
+        await interaction.response.defer()
+
+        try:
+            datetime_start = datetime.min if start is None else datetime.fromisoformat(start)
+            datetime_end = datetime.max if end is None else datetime.fromisoformat(end)
+        except ValueError as e:
+            await interaction.followup.send(f'Invalid time: {e}')
+            return
+
+        contest_id = self.channel_contest_id(interaction.channel_id)
+
+        ContestManager = self.bot.get_cog('ContestManagerInterface')
+        rules = await (await ContestManager.contest_client(contest_id)).rules()
+
+        df = await self.create_score_table(rules.starting_points, rules.target_points, rules.uma, rules.sanma,
+                                           custom_filter=GameLogFilter(datetime_start, datetime_end), contest_id=contest_id)
+        df = df.sort_values(by=self.field_total_score, ascending=False)
+        df = df.reset_index(drop=True)
+        df.index += 1
+
+        embed = await self.convert_to_embed(df, self.score_table_display_fields)
+        await interaction.followup.send(embed=Embed(title=f'Scores ({datetime_start.isoformat()} to {datetime_end.isoformat()})', description=embed or '-'))
+
+    @app_commands.command(name='hand-stats', description='Shows riichi, win, deal-in and call rates from the replays of recorded games')
+    async def command_hand_stats(self, interaction : Interaction):
+        await interaction.response.defer()
+
+        contest_id = self.channel_contest_id(interaction.channel_id)
+        scores = self.contest_scores(contest_id)
+
+        start, end = self.leaderboard_windows(scores)[SEASON_WINDOW]
+        uuids = [uuid for record_index in scores.record_indexes.values() for uuid in record_index.games(start, end)]
+        await self.update_hand_stats(uuids, contest_id)
+
+        df = scores.hand_stats.to_dataframe()
+        df = df.sort_values(by='Hands', ascending=False)
+
+        table = tabulate(df, headers='keys', showindex=False, floatfmt='.1f')
+        await interaction.followup.send(f'```\n{table[:DISCORD_MAX_CHAR_LIMIT]}\n```')
+
+    async def update_hand_stats(self, uuids, contest_id=None, create=True):
+        '''
+        Fetches and decodes the replays of games that aren't counted in the contest's hand
+        statistics yet, a few at a time, adding each as soon as it arrives. With create
+        unset this does nothing until the statistics were asked for once.
+
+        Returns: number of games added
+        '''
+        scores = self.contest_scores(contest_id)
+
+        if scores.hand_stats is None:
+            if not create:
+                return 0
+            scores.hand_stats = HandStatsTable(lq_dhs)
+
+        missing = [uuid for uuid in uuids if uuid not in scores.hand_stats]
+        if not missing:
+            return 0
+
+        ContestManager = self.bot.get_cog('ContestManagerInterface')
+        client = await ContestManager.replay_client()
+
+        added = 0
+        async with aclosing(client.fetch_game_replays(missing, MAX_CONCURRENT_REPLAY_FETCHES, return_exceptions=True)) as replays:
+            async for uuid, head, data in replays:
+                if isinstance(head, Exception):
+                    print(f'Failed to fetch replay {uuid}: {head!r}')
+                    continue
+
+                try:
+                    added += scores.hand_stats.add_replay(uuid, head, data)
+                except ReplayDecodeError as e:
+                    print(f'Failed to decode replay {uuid}: {e}')
+
+        return added
+
     @app_commands.command(name="retrieve-logs", description='Pulls logs')
-    async def command_retrieve_logs(self, interaction : Interaction):
+    @app_commands.describe(full="(optional) Fetch every game in the filter again instead of only new ones")
+    async def command_retrieve_logs(self, interaction : Interaction, full : Optional[bool]):
         await interaction.response.defer()
-        num_found = await self.get_logs()
+        num_found = await self.get_logs(full=bool(full), contest_id=self.channel_contest_id(interaction.channel_id))
         await interaction.followup.send(f"Found {num_found} games.")
 
-    async def get_logs(self):
+    async def get_all_logs(self, full=False):
+        '''
+        Syncs the game records of every configured contest, a few contests at a time.
+        A contest that fails to sync is reported and skipped.
+
+        Returns: contest id -> number of games found
+        '''
         ContestManager = self.bot.get_cog('ContestManagerInterface')
+        contest_ids = [contest['contest_id'] for contest in ContestManager.contests.values()]
+        slots = asyncio.Semaphore(MAX_CONCURRENT_CONTEST_SYNCS)
+
+        async def sync(contest_id):
+            async with slots:
+                return await self.get_logs(full, contest_id)
+
+        results = await asyncio.gather(*[sync(contest_id) for contest_id in contest_ids], return_exceptions=True)
+
+        found = {}
+        for contest_id, result in zip(contest_ids, results):
+            if isinstance(result, Exception):
+                print(f'Failed to retrieve logs of contest {contest_id}: {result!r}')
+            else:
+                found[contest_id] = result
+
+        return found
+
+    async def get_logs(self, full=False, contest_id=None):
+        '''
+        Fetches a contest's game records, by default the one currently managed, and stores them.
+
+        Returns: number of fetched games matching the contest's filter
+
+        Unless full is set, paging stops at the newest game seen by the last search of this
+        contest, provided the store already has everything back to the start of the filter.
+        Routine refreshes then only cost a single page.
+        '''
+        ContestManager = self.bot.get_cog('ContestManagerInterface')
+        client = await ContestManager.contest_client(contest_id)
+
+        scores = self.contest_scores(contest_id)
+        contest_id = scores.contest_id
+        game_log_filter = scores.game_log_filter
 
-        next_index = 0
         continueSearch = True
+        completed = False
+        exhausted = False
+        newest = None
         hits = []
-        self.initialize_dataframe()
 
-        while continueSearch:
-            if self.event_stop_log_search.is_set():
-                self.event_stop_log_search.clear()
-                break
+        filter_start, _ = self.filter_timestamps(game_log_filter)
+        filter_start = filter_start or 0
 
-            res = await ContestManager.client.call('fetchContestGameRecords', last_index=next_index)
-            next_index = res.next_index
+        sync = self.store.get_sync(contest_id)
+        if not full and sync is not None and sync[0] <= filter_start:
+            synced_from, known_end_time, known_uuid = sync
+        else:
+            synced_from, known_end_time, known_uuid = None, None, None
 
-            for item in res.record_list:
-                if self.game_log_filter != None:
-                    if self.game_log_filter.match(datetime.fromtimestamp(item.record.end_time)):
-                        hits.append(item.record)
+        def reached_known(record):
+            # Records come newest first, everything from here on is already stored.
+            return record.uuid == known_uuid or (known_end_time is not None and record.end_time < known_end_time)
+
+        def before_filter(record):
+            return game_log_filter != None and datetime.fromtimestamp(record.end_time) < game_log_filter.datetime_start
 
-                    if datetime.fromtimestamp(item.record.end_time) < self.game_log_filter.datetime_start:
+        pages = asyncio.Queue(maxsize=LOG_PREFETCH_PAGES)
+        producer = asyncio.create_task(self.fetch_record_pages(
+            client, pages, lambda record: reached_known(record) or before_filter(record)))
+
+        try:
+            while continueSearch:
+                if self.event_stop_log_search.is_set():
+                    self.event_stop_log_search.clear()
+                    break
+
+                page = await pages.get()
+                if isinstance(page, Exception):
+                    raise page
+
+                record_list, last_page = page
+                fetched = []
+
+                for item in record_list:
+                    if reached_known(item.record):
                         continueSearch = False
-                else:
-                    hits.append(item.record)
+                        break
+
+                    fetched.append(item.record)
 
-            # Response was only one page long.
-            if next_index == 0:
-                break
+                    if game_log_filter != None:
+                        if game_log_filter.match(datetime.fromtimestamp(item.record.end_time)):
+                            hits.append(item.record)
+
+                        if before_filter(item.record):
+                            continueSearch = False
+                    else:
+                        hits.append(item.record)
+
+                if newest is None and fetched:
+                    newest = fetched[0]
+
+                # Stored page by page so that a stopped search keeps what it already fetched.
+                self.archive_games(contest_id, fetched)
+
+                if last_page:
+                    exhausted = True
+                    break
+            else:
+                completed = True
+        finally:
+            producer.cancel()
+
+        if completed or exhausted:
+            if exhausted and continueSearch:
+                # Paged all the way back to the first game of the contest.
+                synced_from = 0
+            elif synced_from is None:
+                # Searched back to the filter start, which joins up with what was synced before.
+                previous = self.store.get_sync(contest_id)
+                synced_from = filter_start if previous is None else min(filter_start, previous[0])
+
+            if newest is not None:
+                known_end_time, known_uuid = newest.end_time, newest.uuid
+            elif sync is not None and known_uuid is None:
+                _, known_end_time, known_uuid = sync
+
+            self.store.set_sync(contest_id, synced_from, known_end_time, known_uuid)
 
-        await self.record_multiple_games(hits)
         return len(hits)
 
-    async def update_score_posts(self, post_channel_id, post_ids):
-        contents = await self.get_score_content()
-        post_channel = self.bot.get_partial_messageable(post_channel_id)
+    async def fetch_record_pages(self, client, pages, is_boundary):
+        '''
+        Producer half of get_logs. The record list can only be walked by cursor, so instead of
+        requesting pages in parallel this keeps the next request in flight while the consumer
+        ingests the previous page. Queues (record_list, last_page) per page, or the exception
+        that ended the walk.
+
+        Stops after the last page, or after a page whose oldest record is_boundary since the
+        consumer won't read past it.
+        '''
+        next_index = 0
+
+        try:
+            while True:
+                res = await client.call('fetchContestGameRecords', last_index=next_index)
+                next_index = res.next_index
+
+                await pages.put((res.record_list, next_index == 0))
+
+                if next_index == 0 or (res.record_list and is_boundary(res.record_list[-1].record)):
+                    break
+        except Exception as e:
+            await pages.put(e)
+
+    async def update_score_posts(self, post_channel_id, post_ids, contest_id=None):
+        '''
+        Re-renders a contest's score posts and queues edits for the ones whose content changed.
+        The edits are applied in the background by apply_post_edits.
+        '''
+        contents = await self.get_score_content(contest_id)
 
         # note: will silently fail if not enough post_ids
         for content, post_id in zip_longest(contents, post_ids):
             if post_id:
-                post = post_channel.get_partial_message(post_id)
                 if content:
                     title, payload = content
                     embed = Embed(title=title, description=payload)
@@ -323,40 +611,78 @@ class TournamentScoreTracker(commands.Cog):
                     msg = '-'
                     embed = None
 
+                digest = hashlib.sha1(repr((msg, content)).encode()).hexdigest()
+
+                if self.score_post_digests.get(post_id) == digest or self.post_edit_in_flight == (post_id, digest):
+                    # Also drops an edit that was queued since and would now be outdated.
+                    self.pending_post_edits.pop(post_id, None)
+                else:
+                    self.pending_post_edits[post_id] = (post_channel_id, msg, embed, digest)
+
+        if self.pending_post_edits and (self._post_edit_task is None or self._post_edit_task.done()):
+            self._post_edit_task = asyncio.create_task(self.apply_post_edits())
+
+    async def apply_post_edits(self):
+        '''
+        Edits score posts one at a time until none are pending. A post re-rendered while its
+        edit is still queued only gets edited once, to the latest content.
+        '''
+        while self.pending_post_edits:
+            post_id = next(iter(self.pending_post_edits))
+            edit = self.pending_post_edits.pop(post_id)
+            post_channel_id, msg, embed, digest = edit
+
+            post = self.bot.get_partial_messageable(post_channel_id).get_partial_message(post_id)
+
+            # Re-rendering the same content meanwhile doesn't queue it again, see update_score_posts.
+            self.post_edit_in_flight = (post_id, digest)
+
+            try:
                 await post.edit(content=msg, embed=embed)
+                # Only recorded once applied, a failed edit is retried on the next update.
+                self.score_post_digests[post_id] = digest
+            except Exception as e:
+                print(f'Failed to edit score post {post_id}: {e!r}')
 
-    async def get_score_content(self):
-        ContestManager = self.bot.get_cog('ContestManagerInterface')
-        res = await ContestManager.client.call('fetchContestGameRule')
+                if isinstance(e, HTTPException) and e.status == 429:
+                    self.pending_post_edits.setdefault(post_id, edit)
+                    await asyncio.sleep(SCORE_POST_RATE_LIMIT_BACKOFF)
+            finally:
+                self.post_edit_in_flight = None
 
-        rules = res.game_rule_setting.detail_rule_v2.game_rule
+            await asyncio.sleep(SCORE_POST_EDIT_INTERVAL)
 
-        starting_points = rules.init_point
-        target_points = rules.fandian
-        sanma = is_sanma(res.game_rule_setting.round_type)
+    async def get_score_content(self, contest_id=None):
+        ContestManager = self.bot.get_cog('ContestManagerInterface')
+        client = await ContestManager.contest_client(contest_id)
+        rules = await client.rules()
 
-        if sanma:
-            shunweima_1 = (int)(-1*(rules.shunweima_2 + rules.shunweima_3))
-            uma = [shunweima_1, rules.shunweima_2, rules.shunweima_3]
-        else:
-            shunweima_1 = (int)(-1*(rules.shunweima_2 +
-                                    rules.shunweima_3 + rules.shunweima_4))
-            uma = [shunweima_1, rules.shunweima_2, rules.shunweima_3, rules.shunweima_4]
+        scores = self.contest_scores(contest_id)
+
+        starting_points = rules.starting_points
+        target_points = rules.target_points
+        sanma = rules.sanma
+        uma = rules.uma
 
         content = []
 
-        # Monthly scores
-        if self.game_log_filter != None:
-            dt_start = self.game_log_filter.datetime_start.date()
-            dt_end = self.game_log_filter.datetime_end.date()
+        for window, (start, end) in self.leaderboard_windows(scores).items():
+            df = await self.create_score_table(starting_points, target_points, uma, sanma, contest_id=scores.contest_id, window=window)
+            df = df.sort_values(by=self.field_total_score, ascending=False)
+            df = df.reset_index(drop=True)
+            df.index += 1
 
-        df = await self.create_score_table(starting_points, target_points, uma, sanma)
-        df = df.sort_values(by=self.field_total_score, ascending=False)
-        df = df.reset_index(drop=True)
-        df.index += 1
+            embed = await self.convert_to_embed(df, self.score_table_display_fields)
 
-        embed = await self.convert_to_embed(df, self.score_table_display_fields)
-        content.append((f"MONTHLY scores ({dt_start} to {dt_end})", embed))
+            # Monthly scores
+            if window == SEASON_WINDOW:
+                dt_start = scores.game_log_filter.datetime_start.date()
+                dt_end = scores.game_log_filter.datetime_end.date()
+                content.append((f"MONTHLY scores ({dt_start} to {dt_end})", embed))
+            else:
+                dt_start = date.fromtimestamp(start)
+                dt_end = date.fromtimestamp(end)
+                content.append((f"{window.upper()} scores ({dt_start} to {dt_end})", embed))
 
         return content
 
@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+
+from modules.pymjsoul.replay import decode_replay
+
+# Records that hand statistics are computed from; everything else in a replay is skipped unparsed.
+HAND_RECORDS = {'RecordNewRound', 'RecordDiscardTile', 'RecordChiPengGang', 'RecordAnGangAddGang', 'RecordHule'}
+
+# Per-player counters, one column each
+HAND_COLUMNS = ['hands', 'riichi', 'wins', 'deal_ins', 'calls', 'win_points']
+
+INITIAL_CAPACITY = 64
+
+
+def hand_value(hule, seats):
+    '''
+    Returns: points the winner collected for the hand, before honba and riichi sticks
+    '''
+    if hule.point_sum:
+        return hule.point_sum
+    if not hule.zimo:
+        return hule.point_rong
+    if hule.qinjia:
+        return hule.point_zimo_xian * (seats - 1)
+    return hule.point_zimo_qin + hule.point_zimo_xian * (seats - 2)
+
+
+def count_hands(events, seats):
+    '''
+    Tallies a replay's decoded events per seat.
+
+    Returns: (seats x HAND_COLUMNS) array of counts
+    '''
+    counts = np.zeros((seats, len(HAND_COLUMNS)), dtype=np.int64)
+    hands, riichi, wins, deal_ins, calls, win_points = range(len(HAND_COLUMNS))
+
+    riichi_seats = set()
+    called_seats = set()
+    last_discard = None
+
+    def end_round():
+        for seat in riichi_seats:
+            counts[seat, riichi] += 1
+        for seat in called_seats:
+            counts[seat, calls] += 1
+
+    for event in events:
+        msg = event.msg
+
+        if event.name == 'RecordNewRound':
+            end_round()
+            riichi_seats = set()
+            called_seats = set()
+            last_discard = None
+            counts[:, hands] += 1
+        elif event.name == 'RecordDiscardTile':
+            if msg.is_liqi or msg.is_wliqi:
+                riichi_seats.add(msg.seat)
+            last_discard = msg.seat
+        elif event.name == 'RecordChiPengGang':
+            called_seats.add(msg.seat)
+            last_discard = None
+        elif event.name == 'RecordAnGangAddGang':
+            # Robbing a kan deals in from the player who added to it.
+            last_discard = msg.seat
+        elif event.name == 'RecordHule':
+            for hule in msg.hules:
+                counts[hule.seat, wins] += 1
+                counts[hule.seat, win_points] += hand_value(hule, seats)
+
+            # A double ron is still one deal-in.
+            if last_discard is not None and not any(hule.zimo for hule in msg.hules):
+                counts[last_discard, deal_ins] += 1
+
+    end_round()
+
+    return counts
+
+
+class HandStatsTable():
+    '''
+    Per-player hand statistics in columnar form: one numpy array per counter, indexed by
+    player id, grown by doubling so adding a game costs O(seats).
+    '''
+    def __init__(self, proto):
+        self.proto = proto
+
+        self.names = []
+        self.name_ids = {}
+        self.uuids = set()
+
+        self.size = 0
+        self.columns = {column: np.zeros(INITIAL_CAPACITY, dtype=np.int64) for column in HAND_COLUMNS}
+
+    def __contains__(self, uuid):
+        return uuid in self.uuids
+
+    def player_id(self, name):
+        if name not in self.name_ids:
+            if self.size == len(self.columns[HAND_COLUMNS[0]]):
+                for column, values in self.columns.items():
+                    self.columns[column] = np.concatenate([values, np.zeros(len(values), dtype=np.int64)])
+
+            self.name_ids[name] = self.size
+            self.names.append(name)
+            self.size += 1
+
+        return self.name_ids[name]
+
+    def add_replay(self, uuid, head, data):
+        '''
+        Decodes a game's replay and adds its hands to the players' totals. Seats without
+        an account (AI) are left out. Returns False if the game was already counted.
+        '''
+        if uuid in self.uuids:
+            return False
+
+        seats = len(head.result.players) or 4
+        counts = count_hands(decode_replay(data, self.proto, HAND_RECORDS), seats)
+
+        for account in head.accounts:
+            if account.account_id == 0 or account.seat >= seats:
+                continue
+
+            player = self.player_id(account.nickname)
+            for column, count in zip(HAND_COLUMNS, counts[account.seat]):
+                self.columns[column][player] += count
+
+        self.uuids.add(uuid)
+        return True
+
+    def to_dataframe(self):
+        '''
+        Returns: per-player hands played and riichi, win, deal-in and call rates per hand,
+        along with the average value of a winning hand
+        '''
+        c = {column: values[:self.size] for column, values in self.columns.items()}
+        hands = np.maximum(c['hands'], 1)
+
+        return pd.DataFrame({
+            'Name': self.names,
+            'Hands': c['hands'],
+            'Riichi %': 100 * c['riichi'] / hands,
+            'Win %': 100 * c['wins'] / hands,
+            'Deal-in %': 100 * c['deal_ins'] / hands,
+            'Call %': 100 * c['calls'] / hands,
+            'Avg Win': c['win_points'] / np.maximum(c['wins'], 1),
+        }).set_index('Name', drop=False)
@@ -0,0 +1,127 @@
+import numpy as np
+
+
+class RecordIndex():
+    '''
+    Game records of one table size kept sorted by end time in flat arrays.
+
+    Any time range is a pair of binary searches and a slice, and standings over it are
+    a few bincounts over that slice, so leaderboard windows and ad-hoc ranges alike don't
+    need a pass over every record.
+    '''
+    def __init__(self, seats):
+        self.seats = seats
+
+        self.end_times = np.empty(0, dtype=np.int64)
+        # rows of player ids / points in placement order
+        self.player_ids = np.empty((0, seats), dtype=np.int32)
+        self.points = np.empty((0, seats), dtype=float)
+        self.game_uuids = np.empty(0, dtype=object)
+        self.uuids = set()
+
+        # player id <-> name
+        self.names = []
+        self.name_ids = {}
+
+        # rules key -> (score_batch, scores aligned with the rows)
+        self.scores = {}
+        # (rules key, start, end) -> standings rows, until the next game is added
+        self.standings_cache = {}
+
+    def __len__(self):
+        return len(self.end_times)
+
+    def __contains__(self, uuid):
+        return uuid in self.uuids
+
+    def player_id(self, name):
+        if name not in self.name_ids:
+            self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return self.name_ids[name]
+
+    def add_games(self, entries):
+        '''
+        Adds game record entries (uuid, end time, player names, then points), keeping the
+        rows sorted. Games that are already indexed are skipped.
+
+        Returns: number of games added
+        '''
+        entries = [entry for entry in entries if entry[0] not in self.uuids]
+        if not entries:
+            return 0
+
+        end_times = np.array([entry[1] for entry in entries], dtype=np.int64)
+        player_ids = np.array([[self.player_id(name) for name in entry[2:2 + self.seats]] for entry in entries], dtype=np.int32)
+        points = np.array([entry[2 + self.seats:2 + 2 * self.seats] for entry in entries], dtype=float)
+        game_uuids = np.array([entry[0] for entry in entries], dtype=object)
+
+        order = np.argsort(end_times, kind='stable')
+        end_times, player_ids, points, game_uuids = end_times[order], player_ids[order], points[order], game_uuids[order]
+
+        # New games usually end after everything indexed, which makes this an append.
+        positions = np.searchsorted(self.end_times, end_times, side='right')
+
+        self.end_times = np.insert(self.end_times, positions, end_times)
+        self.player_ids = np.insert(self.player_ids, positions, player_ids, axis=0)
+        self.points = np.insert(self.points, positions, points, axis=0)
+        self.game_uuids = np.insert(self.game_uuids, positions, game_uuids)
+        self.uuids.update(game_uuids)
+
+        for key, (score_batch, scores) in self.scores.items():
+            self.scores[key] = (score_batch, np.insert(scores, positions, score_batch(points), axis=0))
+
+        self.standings_cache.clear()
+
+        return len(entries)
+
+    def range(self, start=None, end=None):
+        '''
+        Returns: slice of the rows that ended between start and end (unix timestamps,
+        inclusive, None where unbounded)
+        '''
+        lo = 0 if start is None else np.searchsorted(self.end_times, start, side='left')
+        hi = len(self.end_times) if end is None else np.searchsorted(self.end_times, end, side='right')
+        return slice(lo, hi)
+
+    def games(self, start=None, end=None):
+        '''
+        Returns: uuids of the games that ended between start and end, oldest first
+        '''
+        return list(self.game_uuids[self.range(start, end)])
+
+    def standings(self, key, score_batch, start=None, end=None):
+        '''
+        Standings over the games that ended between start and end. Every indexed game is
+        scored once per rules key, with score_batch(points) -> scores for a (games x seats) array.
+
+        Lookups are cached until the next game is added, so rendering the same windows
+        again between games costs nothing.
+
+        Returns: rows of name, total score, average score, matches played, then placement
+        counts for 1st to 4th, for every player with a game in the range
+        '''
+        cached = self.standings_cache.get((key, start, end))
+        if cached is not None:
+            return cached
+
+        if key not in self.scores:
+            self.scores[key] = (score_batch, np.asarray(score_batch(self.points), dtype=float).reshape(-1, self.seats))
+
+        _, scores = self.scores[key]
+        rows = self.range(start, end)
+
+        player_ids = self.player_ids[rows]
+        size = len(self.names)
+
+        totals = np.bincount(player_ids.ravel(), weights=scores[rows].ravel(), minlength=size)
+        placements = [np.bincount(player_ids[:, seat], minlength=size) for seat in range(self.seats)]
+        placements += [np.zeros(size, dtype=np.int64)] * (4 - self.seats)
+        played = sum(placements)
+
+        rows = [[self.names[player], totals[player], totals[player] / played[player], int(played[player]),
+                 *[int(p[player]) for p in placements]]
+                for player in np.flatnonzero(played)]
+
+        self.standings_cache[(key, start, end)] = rows
+        return rows
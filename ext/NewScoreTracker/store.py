@@ -0,0 +1,102 @@
+import sqlite3
+
+# Let SQLite memory-map up to this many bytes of the database file.
+MMAP_SIZE = 256 * 1024 * 1024
+
+SEATS = 4
+
+
+class GameRecordStore():
+    '''
+    Append-only on-disk store of contest game records, keyed by game uuid and partitioned by
+    the contest they were played in.
+
+    Rows are game record entries as used by TournamentScoreTracker:
+    uuid, end time, player names in placement order, then their points.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+
+        players = ', '.join([f'player_{n} TEXT' for n in range(1, SEATS + 1)])
+        points = ', '.join([f'points_{n} INTEGER' for n in range(1, SEATS + 1)])
+
+        with self.connection:
+            self.connection.execute(f'''CREATE TABLE IF NOT EXISTS games (
+                uuid TEXT PRIMARY KEY,
+                end_time INTEGER NOT NULL,
+                sanma INTEGER NOT NULL,
+                {players},
+                {points},
+                contest_id INTEGER NOT NULL)''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS games_contest_end_time ON games (contest_id, end_time)')
+            # Per contest: every game that ended between synced_from and end_time is stored,
+            # uuid being the newest of them.
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS sync (
+                contest_id INTEGER PRIMARY KEY,
+                synced_from INTEGER NOT NULL,
+                end_time INTEGER,
+                uuid TEXT)''')
+
+    def add_games(self, contest_id, sanma, entries):
+        '''
+        Stores game record entries of a contest. Games that are already stored are left alone.
+
+        Returns: number of games added
+        '''
+        seats = 3 if sanma else 4
+        padding = [None] * (SEATS - seats)
+
+        rows = [(uuid, end_time, int(sanma), *rest[:seats], *padding, *rest[seats:], *padding, contest_id)
+                for uuid, end_time, *rest in entries]
+
+        players = ', '.join([f'player_{n}' for n in range(1, SEATS + 1)])
+        points = ', '.join([f'points_{n}' for n in range(1, SEATS + 1)])
+
+        with self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                f'''INSERT OR IGNORE INTO games (uuid, end_time, sanma, {players}, {points}, contest_id)
+                VALUES ({", ".join(["?"] * (4 + 2 * SEATS))})''', rows)
+            return self.connection.total_changes - before
+
+    def load(self, contest_id, sanma, start_time=None, end_time=None):
+        '''
+        Returns: stored game record entries of a contest ordered by end time, optionally
+        limited to games that ended between start_time and end_time (unix timestamps, inclusive)
+        '''
+        seats = 3 if sanma else 4
+        players = ', '.join([f'player_{n}' for n in range(1, seats + 1)])
+        points = ', '.join([f'points_{n}' for n in range(1, seats + 1)])
+
+        query = f'SELECT uuid, end_time, {players}, {points} FROM games WHERE contest_id = ? AND sanma = ?'
+        params = [contest_id, int(sanma)]
+
+        if start_time is not None:
+            query += ' AND end_time >= ?'
+            params.append(start_time)
+        if end_time is not None:
+            query += ' AND end_time <= ?'
+            params.append(end_time)
+
+        query += ' ORDER BY end_time'
+
+        return [list(row) for row in self.connection.execute(query, params)]
+
+    def get_sync(self, contest_id):
+        '''
+        Returns: (synced_from, end_time, uuid) of the contest's last sync, or None
+        '''
+        return self.connection.execute(
+            'SELECT synced_from, end_time, uuid FROM sync WHERE contest_id = ?', (contest_id,)).fetchone()
+
+    def set_sync(self, contest_id, synced_from, end_time, uuid):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO sync VALUES (?, ?, ?, ?)',
+                                    (contest_id, synced_from, end_time, uuid))
+
+    def close(self):
+        self.connection.close()
@@ -1,3 +1,5 @@
+import numpy as np
+
 from discord.ext import commands
 
 class ScoreCalculator(commands.Cog):
@@ -76,6 +78,62 @@ class ScoreCalculator(commands.Cog):
                 raw_scores[2] + uma[2],
                 raw_scores[3] + uma[3]]
 
+    def calculate_scores_batch(self, raw_scores, starting_score, target_score, uma):
+        '''
+        Scores many games at once.
+
+        Param:
+            raw_scores : array-like of shape (games, 3) or (games, 4)
+                Final points of each game in placement order, same as calculate_scores.
+
+        Returns: numpy array of the same shape with the score of every seat
+        '''
+        raw_scores = np.asarray(raw_scores, dtype=float)
+        if raw_scores.ndim != 2:
+            raise ValueError(f'Expected a 2D array of points, got shape {raw_scores.shape}')
+
+        players = raw_scores.shape[1]
+        if players == 4:
+            return self.calculate_yonma_scores_batch(raw_scores, starting_score, target_score, uma)
+        elif players == 3:
+            return self.calculate_sanma_scores_batch(raw_scores, starting_score, target_score, uma)
+
+    def calculate_sanma_scores_batch(self, raw_scores, starting_score, target_score, uma):
+        # XXX: No support for split uma
+        return (raw_scores - target_score) / 1000 + np.asarray(uma, dtype=float)
+
+    def calculate_yonma_scores_batch(self, raw_scores, starting_score, target_score, uma):
+        oka = ((target_score - starting_score) * 4) / 1000
+        points = raw_scores
+        raw_scores = (points - target_score) / 1000
+
+        u = [float(x) for x in uma]
+        tie_01 = points[:, 0] == points[:, 1]
+        tie_12 = points[:, 1] == points[:, 2]
+        tie_23 = points[:, 2] == points[:, 3]
+
+        # Same cases as calculate_yonma_scores. Each row of bonuses replaces the ones before
+        # it where its case applies, so they go from the lowest precedence to the highest.
+        cases = [
+            (tie_23, [oka + u[0], u[1], (u[2] + u[3]) / 2, (u[2] + u[3]) / 2]),
+            (tie_12, [oka + u[0], (u[1] + u[2]) / 2, (u[1] + u[2]) / 2, u[3]]),
+            (tie_01, [(u[0] + u[1]) / 2 + oka / 2, (u[0] + u[1]) / 2 + oka / 2, u[2], u[3]]),
+            (tie_12 & tie_23, [oka + u[0], *[(u[1] + u[2] + u[3]) / 3] * 3]),
+            (tie_01 & tie_12, [*[(u[0] + u[1] + u[2]) / 3 + oka / 3] * 3, u[3]]),
+        ]
+
+        bonus = np.empty_like(raw_scores)
+        bonus[:] = [oka + u[0], u[1], u[2], u[3]]
+        for mask, case_bonus in cases:
+            bonus[mask] = case_bonus
+
+        scores = raw_scores + bonus
+
+        # Four-way tie
+        scores[tie_01 & tie_12 & tie_23] = 0
+
+        return scores
+
 async def setup(bot):
     await bot.add_cog(ScoreCalculator(bot))
             
@@ -1,8 +1,11 @@
 import asyncio
+import traceback
+from collections import OrderedDict
 
 import websockets
 
 import google.protobuf as pb
+from google.protobuf.message import DecodeError
 from .errors import ERRORS
 
 MSG_TYPE_NOTIFY = 1
@@ -11,6 +14,13 @@ MSG_TYPE_RESPONSE = 3
 
 MAX_MSG_INDEX = 2**16
 
+# Seconds to wait between reconnection attempts, the last value repeats forever.
+RECONNECT_BACKOFF = [1, 2, 4, 8, 16, 30]
+
+# How long the index of a timed out request stays reserved for its late response
+# before it may be reused.
+ABANDONED_INDEX_TTL = 60
+
 class MethodNotFoundError(Exception):
     def __init__(self, methodName, moduleName):
         self.message = f"No method named '{methodName}' in module '{moduleName}'"
@@ -21,50 +31,271 @@ class ResponseTimeoutError(Exception):
         self.message = f"Response not received within specified timeout duration ({timeoutDuration}s)"
         super().__init__(self.message)
 
+class ConnectionLostError(Exception):
+    def __init__(self):
+        self.message = "Connection to the server was lost before a response was received"
+        super().__init__(self.message)
+
+class ReconnectTimeoutError(Exception):
+    def __init__(self, timeoutDuration):
+        self.message = f"Connection to the server was not re-established within specified timeout duration ({timeoutDuration}s)"
+        super().__init__(self.message)
+
+class RequestSlotsExhaustedError(Exception):
+    def __init__(self):
+        self.message = f"All {MAX_MSG_INDEX} message indexes are in use by pending requests"
+        super().__init__(self.message)
+
 class GeneralMajsoulError(Exception):
     def __init__(self, errorCode, message):
         self.message = f"ERROR CODE {errorCode}: {message}"
         super().__init__(self.message)
 
+class ProtoRegistry():
+    '''
+    Memoized lookup of the protobuf classes used by a proto module.
+
+    Building a message class from its descriptor and searching every service for
+    a method is expensive, and a channel uses the same handful of messages all
+    night, so each one is only resolved once per proto module.
+    '''
+    _registries = {}
+
+    def __init__(self, proto):
+        self.proto = proto
+
+        # (method name, service name) -> (full name, request class, response class)
+        self.methods = {}
+        # message name -> message class
+        self.messages = {}
+
+    @classmethod
+    def get(cls, proto):
+        registry = cls._registries.get(proto.__name__)
+
+        if registry is None:
+            registry = cls(proto)
+            cls._registries[proto.__name__] = registry
+
+        return registry
+
+    def method(self, methodName, serviceName=None):
+        key = (methodName, serviceName)
+
+        if key not in self.methods:
+            methodDescriptor = self.method_lookup(methodName, serviceName)
+
+            self.methods[key] = (
+                f'.{methodDescriptor.full_name}',
+                pb.reflection.MakeClass(methodDescriptor.input_type),
+                pb.reflection.MakeClass(methodDescriptor.output_type),
+            )
+
+        return self.methods[key]
+
+    def message(self, messageName):
+        if messageName not in self.messages:
+            self.messages[messageName] = pb.reflection.MakeClass(self.message_lookup(messageName))
+
+        return self.messages[messageName]
+
+    def method_lookup(self, methodName, serviceName):
+        methodDescriptor = None
+
+        if serviceName:
+            serviceDescriptor = self.proto.DESCRIPTOR.services_by_name[serviceName]
+            methodDescriptor = serviceDescriptor.FindMethodByName(methodName)
+        else:
+            for serviceDescriptor in self.proto.DESCRIPTOR.services_by_name.values():
+                try:
+                    methodDescriptor = serviceDescriptor.FindMethodByName(methodName)
+                    # if not found then continue to the next serviceDescriptor
+                    if methodDescriptor == None:
+                        continue
+                    break
+                # legacy, keeping this for now
+                except KeyError:
+                    continue
+
+        if methodDescriptor == None:
+            raise MethodNotFoundError(methodName, self.proto.__name__)
+
+        return methodDescriptor
+
+    def message_lookup(self, messageName):
+        return self.proto.DESCRIPTOR.message_types_by_name[messageName]
+
+class DispatchStats():
+    '''
+    Backpressure counters for one notification topic.
+    '''
+    def __init__(self):
+        self.dispatched = 0
+        self.max_depth = 0
+        # Times a notification had to wait for room in the topic queue, and for how long in total.
+        self.blocked = 0
+        self.blocked_seconds = 0.0
+
+    def __repr__(self):
+        return (f'DispatchStats(dispatched={self.dispatched}, max_depth={self.max_depth}, '
+                f'blocked={self.blocked}, blocked_seconds={self.blocked_seconds:.2f})')
+
 class MajsoulChannel():
     _RESPONSE_TIMEOUT_DURATION = 10
+    # Notifications buffered per topic before eventloop() has to wait for its subscribers.
+    _TOPIC_QUEUE_SIZE = 64
+    # Identical notify frames seen again within this many seconds are dropped as duplicates.
+    _NOTIFY_DEDUP_WINDOW = 3
+    _NOTIFY_DEDUP_SIZE = 128
+    # How long a request waits for the connection to be (re-)established before giving up.
+    _RECONNECT_TIMEOUT_DURATION = 60
+    # How many times an idempotent request is sent again after the connection dropped while
+    # it was in flight, before ConnectionLostError is raised to the caller.
+    _MAX_REPLAYS = 3
+
+    # Methods that are safe to send again after a reconnect. Methods starting with
+    # 'fetch' are always considered idempotent.
+    _IDEMPOTENT_METHODS = set()
 
     def __init__(self, proto, log_messages=False):
         self.websocket = None
         self.websocket_lock = asyncio.Lock()
 
         self.uri = None
+        self._closing = False
+        self._ready = asyncio.Event()
+        self._supervisor = None
+        self._eventloop = None
 
         self.proto = proto
+        self.registry = ProtoRegistry.get(proto)
 
         self.index = 0
-        self.requests = {}
-        self.responses = {}
+        # msgIndex -> (future, response message class or None)
+        self.pending = {}
+        # msgIndex -> time the request timed out, reserved until its response shows up
+        self.abandoned = {}
+        self.late_responses = 0
 
         self._subscriptions = {}
         self._subscriptions_lock = asyncio.Lock()
 
-        self.MostRecentNotify = None
+        # notification name -> (queue, dispatch task)
+        self._topics = {}
+        self.dispatch_stats = {}
+
+        # raw notify payload -> time it was last received
+        self._recent_notifies = OrderedDict()
+        self.duplicate_notifies = 0
         self.Notifications = asyncio.Queue()
         self.log_messages = log_messages
 
+        # optional standin.SessionRecorder that every frame sent and received is captured to
+        self.recorder = None
+
     async def connect(self, uri):
         self.uri = uri
+        self._closing = False
 
         self.websocket = await websockets.connect(self.uri)
 
         print(f'Connected to {self.uri}')
 
-        asyncio.create_task(self.sustain())
-        asyncio.create_task(self.listen())
-        asyncio.create_task(self.eventloop())
+        if self._eventloop is None or self._eventloop.done():
+            self._eventloop = asyncio.create_task(self.eventloop())
+
+        self._supervisor = asyncio.create_task(self.supervise())
+
+    async def supervise(self):
+        '''
+        Looping coroutine that owns the connection. Runs listen() and sustain() for as long as
+        the websocket stays open, and reconnects and resumes the session when it drops.
+        '''
+        while True:
+            self._ready.set()
+
+            sustainer = asyncio.create_task(self.sustain())
+            try:
+                await self.listen()
+            except websockets.ConnectionClosed:
+                pass
+            except Exception:
+                # Anything else leaves the stream in an unknown state, so start over on a new connection.
+                print(f'Listener for {self.uri} raised an exception:')
+                traceback.print_exc()
+                await self.websocket.close()
+            finally:
+                sustainer.cancel()
+                self._ready.clear()
+
+            # Requests sent on the dead socket will never get a response.
+            self.fail_pending(ConnectionLostError())
+            self.abandoned.clear()
+
+            if self._closing:
+                return
+
+            print(f'Lost connection to {self.uri}')
+            await self.reconnect()
+
+    async def reconnect(self):
+        '''
+        Re-opens the websocket with backoff until a connection is made and the session is resumed.
+        '''
+        attempt = 0
+
+        while not self._closing:
+            await asyncio.sleep(RECONNECT_BACKOFF[min(attempt, len(RECONNECT_BACKOFF) - 1)])
+            attempt += 1
+
+            try:
+                self.websocket = await websockets.connect(self.uri)
+            except Exception as e:
+                print(f'Reconnect attempt {attempt} to {self.uri} failed: {e}')
+                continue
+
+            # The session has to be resumed before other requests can go out, so resume()
+            # runs on a listener of its own while everyone else waits for _ready.
+            listener = asyncio.create_task(self.listen())
+            try:
+                await self.resume()
+            except Exception as e:
+                print(f'Resuming session after reconnect attempt {attempt} failed: {e}')
+                await self.websocket.close()
+                continue
+            finally:
+                listener.cancel()
+                try:
+                    await listener
+                except (asyncio.CancelledError, websockets.ConnectionClosed):
+                    pass
+
+            print(f'Reconnected to {self.uri}')
+            return
+
+    async def resume(self):
+        '''
+        Restores server-side session state after a reconnect. Subclasses override this to log
+        back in. Subscriptions are kept by the channel and don't need to be registered again.
+        '''
+        pass
+
+    def fail_pending(self, exc):
+        for resFuture, _ in self.pending.values():
+            if not resFuture.done():
+                resFuture.set_exception(exc)
+
+        self.pending.clear()
 
     async def sustain(self, ping_interval=3):
         '''
         Looping coroutine that keeps the connection to the server alive.
         '''
         while self.websocket.open:
-            await self.websocket.ping()
+            try:
+                await self.websocket.ping()
+            except websockets.ConnectionClosed:
+                return
             await asyncio.sleep(ping_interval)
 
     async def subscribe(self, name, cb):
@@ -75,65 +306,207 @@ class MajsoulChannel():
                 self._subscriptions[name] = [cb]
 
     async def eventloop(self):
-        ''' Event loop running as a separate coroutine to listen(), otherwise we can run into deadlock. '''
+        '''
+        Event loop running as a separate coroutine to listen(), otherwise we can run into deadlock.
+
+        Every notification name gets its own queue and dispatch task, so a slow subscriber only
+        holds up later notifications of the same name, which are still handled in order.
+        '''
+        loop = asyncio.get_running_loop()
+
         while True:
             name, msg = await self.Notifications.get()
-            if name in self._subscriptions:
-                for sub_callback in self._subscriptions[name]:
-                    await sub_callback(name, msg)
-            else:
+            if name not in self._subscriptions:
                 print(f"Notification for {name} had no subscribers.")
+                continue
+
+            queue = self.topic_queue(name)
+            stats = self.dispatch_stats[name]
+
+            if queue.full():
+                stats.blocked += 1
+                blocked_at = loop.time()
+                await queue.put((name, msg))
+                stats.blocked_seconds += loop.time() - blocked_at
+            else:
+                queue.put_nowait((name, msg))
+
+            stats.max_depth = max(stats.max_depth, queue.qsize())
+
+    def topic_queue(self, name):
+        if name not in self._topics:
+            queue = asyncio.Queue(maxsize=self._TOPIC_QUEUE_SIZE)
+            self._topics[name] = (queue, asyncio.create_task(self.dispatch(queue)))
+            self.dispatch_stats.setdefault(name, DispatchStats())
+
+        return self._topics[name][0]
+
+    async def dispatch(self, queue):
+        '''
+        Looping coroutine that hands one topic's notifications to its subscribers, one at a time.
+        '''
+        while True:
+            name, msg = await queue.get()
+
+            for sub_callback in list(self._subscriptions.get(name, [])):
+                try:
+                    await sub_callback(name, msg)
+                except Exception:
+                    print(f"Subscriber for {name} raised an exception:")
+                    traceback.print_exc()
+
+            self.dispatch_stats[name].dispatched += 1
 
     async def listen(self):
         '''
         Looping coroutine that receives messages from the server.
         '''
         async for message in self.websocket:
+            if self.recorder is not None:
+                self.recorder.record('received', message)
+
             msgType = int.from_bytes(message[0:1], 'little')
 
             if msgType == MSG_TYPE_NOTIFY:
                 msgPayload = message[1:]
-                name, data = self.unwrap(msgPayload)
+
+                # Duplicate notifications can be received in bursts.
+                # Never process the same message twice.
+                if self.is_duplicate_notify(msgPayload):
+                    continue
+
+                try:
+                    name, data = self.unwrap(msgPayload)
+                except DecodeError as e:
+                    print(f'Dropped malformed notification: {e}')
+                    continue
 
                 name = name.strip(f'.{self.proto.DESCRIPTOR.package}')
 
                 try:
-                    msgDescriptor = self.message_lookup(name)
+                    msgClass = self.registry.message(name)
                 except KeyError as e:
                     print(e)
                     continue
 
-                msgClass = pb.reflection.MakeClass(msgDescriptor)
-
                 msg = msgClass()
-                msg.ParseFromString(data)
+                try:
+                    msg.ParseFromString(data)
+                except DecodeError as e:
+                    print(f'Dropped malformed {name} notification: {e}')
+                    continue
 
-                # Duplicate notifications can be received next to each other.
-                # Never process the same message twice.
-                if (name, msg) != self.MostRecentNotify:
-                    if self.log_messages:
-                        print("Notification received.")
-                        print(name)
-                        print(msg)
-                    self.MostRecentNotify = (name, msg)
-
-                    await self.Notifications.put((name, msg))
+                if self.log_messages:
+                    print("Notification received.")
+                    print(name)
+                    print(msg)
+
+                self.notified(name, msg)
+                await self.Notifications.put((name, msg))
             elif msgType == MSG_TYPE_RESPONSE:
-                print("Response received.")
                 msgIndex = int.from_bytes(message[1:3], 'little')
-                msgPayload = message[3:]
+                self.resolve(msgIndex, message[3:])
 
-                if msgIndex in self.requests:
-                    name, data = self.unwrap(msgPayload)
-                    self.responses[msgIndex] = data
+    def notified(self, name, msg):
+        '''
+        Called for every notification as soon as it is parsed, before any subscriber sees it.
+        Subclasses override this to keep cached state in sync.
+        '''
+        pass
+
+    def is_duplicate_notify(self, msgPayload):
+        '''
+        Checks the raw payload of a notify frame against the ones received in the last
+        _NOTIFY_DEDUP_WINDOW seconds, before any protobuf parsing happens.
+        '''
+        now = asyncio.get_running_loop().time()
+        recent = self._recent_notifies
+
+        # Entries are kept in arrival order, so expired ones are always at the front.
+        while recent:
+            _, seen_at = next(iter(recent.items()))
+            if now - seen_at < self._NOTIFY_DEDUP_WINDOW and len(recent) < self._NOTIFY_DEDUP_SIZE:
+                break
+            recent.popitem(last=False)
+
+        if msgPayload in recent:
+            self.duplicate_notifies += 1
+            return True
+
+        recent[msgPayload] = now
+        return False
+
+    def resolve(self, msgIndex, msgPayload):
+        '''
+        Routes a response payload to the future of the request that is waiting for it.
+        '''
+        if msgIndex not in self.pending:
+            # The request already timed out (or was never ours).
+            self.abandoned.pop(msgIndex, None)
+            self.late_responses += 1
+            print(f"Late response received for message index {msgIndex}.")
+            return
+
+        resFuture, resMessageClass = self.pending.pop(msgIndex)
+
+        if resFuture.done():
+            return
+
+        try:
+            name, data = self.unwrap(msgPayload)
+
+            if resMessageClass is None:
+                resFuture.set_result(data)
+            else:
+                resMessage = resMessageClass()
+                resMessage.ParseFromString(data)
+                resFuture.set_result(resMessage)
+        except Exception as e:
+            resFuture.set_exception(e)
+
+    def next_index(self):
+        '''
+        Returns the next free message index, skipping indexes that still belong to
+        a pending request or to a recently timed out one whose response may still arrive.
+        '''
+        now = asyncio.get_running_loop().time()
+
+        for _ in range(MAX_MSG_INDEX):
+            msgIndex = self.index
+            self.index = (self.index + 1) % MAX_MSG_INDEX
+
+            if msgIndex in self.pending:
+                continue
+
+            abandonedAt = self.abandoned.get(msgIndex)
+            if abandonedAt is not None:
+                if now - abandonedAt < ABANDONED_INDEX_TTL:
+                    continue
+                del self.abandoned[msgIndex]
 
-                    resEvent = self.requests[msgIndex]
-                    resEvent.set()
+            return msgIndex
+
+        raise RequestSlotsExhaustedError()
 
     async def close(self):
+        self._closing = True
         await self.websocket.close()
 
-    async def send(self, name:str, data:bytes):
+        # Stops a reconnect that is underway as well, and the notification tasks, which
+        # connect() starts again.
+        tasks = [self._supervisor, self._eventloop] + [task for _, task in self._topics.values()]
+        tasks = [task for task in tasks if task is not None]
+        self._topics.clear()
+
+        for task in tasks:
+            task.cancel()
+
+        # close() may be called from a subscriber, whose own task can't be waited on.
+        await asyncio.gather(*[task for task in tasks if task is not asyncio.current_task()], return_exceptions=True)
+
+        self.fail_pending(ConnectionLostError())
+
+    async def send(self, name:str, data:bytes, resMessageClass=None, idempotent=False):
         '''
         Sends a message/request to the server.
 
@@ -145,6 +518,16 @@ class MajsoulChannel():
                 Message payload to be sent. This needs to be a byte string. After creating a protobuf message 'msg'
                 you can call msg.SerializeToString() and pass it in as this parameter.
 
+            resMessageClass : protobuf message class (optional)
+                If given, the response is parsed into this class by the listener and the
+                message is returned. Otherwise the raw response payload bytes are returned.
+
+            idempotent : bool (optional)
+                If the connection drops while the request is in flight, send it again once the
+                session has been resumed, up to _MAX_REPLAYS times, instead of raising
+                ConnectionLostError. Requests that time out waiting for the connection to be
+                re-established raise ReconnectTimeoutError either way.
+
         Info:
             The messages that are sent/received are formatted differently depending on the type of message (notify/request/response).
 
@@ -167,30 +550,61 @@ class MajsoulChannel():
                     |_______|_______ _______
         '''
 
-        msgIndex = self.index
-        self.index = (self.index + 1) % MAX_MSG_INDEX
+        replays = 0
 
-        wrapped = self.wrap(name, data)
-        message = MSG_TYPE_REQUEST.to_bytes(1, 'little') + msgIndex.to_bytes(2, 'little') + wrapped
+        while True:
+            try:
+                return await self.send_once(name, data, resMessageClass)
+            except ConnectionLostError:
+                if not idempotent or self._closing or replays >= self._MAX_REPLAYS:
+                    raise
 
-        resEvent = asyncio.Event()
-        self.requests[msgIndex] = resEvent
+                replays += 1
+                print(f'Replaying {name} after reconnect ({replays}/{self._MAX_REPLAYS}).')
 
-        async with self.websocket_lock:
-            await self.websocket.send(message)
+    async def send_once(self, name, data, resMessageClass=None):
+        if self._closing:
+            raise ConnectionLostError()
 
+        # Everything but the session resume itself waits until the connection is usable.
+        if asyncio.current_task() is not self._supervisor:
             try:
-                await asyncio.wait_for(resEvent.wait(), timeout=self._RESPONSE_TIMEOUT_DURATION)
+                await asyncio.wait_for(self._ready.wait(), timeout=self._RECONNECT_TIMEOUT_DURATION)
             except asyncio.TimeoutError:
-                del self.requests[msgIndex]
-                raise ResponseTimeoutError(self._RESPONSE_TIMEOUT_DURATION)
+                raise ReconnectTimeoutError(self._RECONNECT_TIMEOUT_DURATION)
 
-            res = self.responses[msgIndex]
+        msgIndex = self.next_index()
 
-            del self.responses[msgIndex]
-            del self.requests[msgIndex]
+        wrapped = self.wrap(name, data)
+        message = MSG_TYPE_REQUEST.to_bytes(1, 'little') + msgIndex.to_bytes(2, 'little') + wrapped
 
-            return res
+        resFuture = asyncio.get_running_loop().create_future()
+        self.pending[msgIndex] = (resFuture, resMessageClass)
+
+        # Only the frame write needs to be exclusive. Responses are matched back
+        # to their request by index in listen(), so any number of requests can
+        # be in flight on the socket at once.
+        try:
+            async with self.websocket_lock:
+                # Recorded first, the response can be received before send() returns.
+                if self.recorder is not None:
+                    self.recorder.record('sent', message)
+
+                await self.websocket.send(message)
+
+            return await asyncio.wait_for(resFuture, timeout=self._RESPONSE_TIMEOUT_DURATION)
+        except websockets.ConnectionClosed:
+            raise ConnectionLostError()
+        except asyncio.TimeoutError:
+            # Keep the index reserved so a late response can't be mistaken for
+            # the response to a newer request.
+            self.abandoned[msgIndex] = asyncio.get_running_loop().time()
+            raise ResponseTimeoutError(self._RESPONSE_TIMEOUT_DURATION)
+        except asyncio.CancelledError:
+            self.abandoned[msgIndex] = asyncio.get_running_loop().time()
+            raise
+        finally:
+            self.pending.pop(msgIndex, None)
 
     async def call(self, methodName, **msgFields):
         '''
@@ -219,18 +633,13 @@ class MajsoulChannel():
             serviceName = msgFields['serviceName']
             del msgFields['serviceName']
 
-        methodDescriptor = self.method_lookup(methodName, serviceName)
+        msgName, reqMessageClass, resMessageClass = self.registry.method(methodName, serviceName)
 
-        msgName = f'.{methodDescriptor.full_name}'
-
-        reqMessageClass = pb.reflection.MakeClass(methodDescriptor.input_type)
         reqMessage = reqMessageClass(**msgFields)
 
-        resData = await self.send(msgName, reqMessage.SerializeToString())
+        idempotent = methodName.startswith('fetch') or methodName in self._IDEMPOTENT_METHODS
 
-        resMessageClass = pb.reflection.MakeClass(methodDescriptor.output_type)
-        resMessage = resMessageClass()
-        resMessage.ParseFromString(resData)
+        resMessage = await self.send(msgName, reqMessage.SerializeToString(), resMessageClass, idempotent)
 
         if resMessage.error.code:
             print(resMessage)
@@ -242,30 +651,10 @@ class MajsoulChannel():
         return resMessage
 
     def method_lookup(self, methodName, serviceName):
-        methodDescriptor = None
-
-        if serviceName:
-            serviceDescriptor = self.proto.DESCRIPTOR.services_by_name[serviceName]
-            methodDescriptor = serviceDescriptor.FindMethodByName(methodName)
-        else:
-            for serviceDescriptor in self.proto.DESCRIPTOR.services_by_name.values():
-                try:
-                    methodDescriptor = serviceDescriptor.FindMethodByName(methodName)
-                    # if not found then continue to the next serviceDescriptor
-                    if methodDescriptor == None:
-                        continue
-                    break
-                # legacy, keeping this for now
-                except KeyError:
-                    continue
-
-        if methodDescriptor == None:
-            raise MethodNotFoundError(methodName, self.proto.__name__)
-
-        return methodDescriptor
+        return self.registry.method_lookup(methodName, serviceName)
 
     def message_lookup(self, messageName):
-        return self.proto.DESCRIPTOR.message_types_by_name[messageName]
+        return self.registry.message_lookup(messageName)
 
     def wrap(self, name, data):
         msg = self.proto.Wrapper(name=name, data=data)
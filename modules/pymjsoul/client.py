@@ -1,14 +1,24 @@
+import aiohttp
 import asyncio
 import random
+from contextlib import aclosing
 
 from .channel import MajsoulChannel
 from .mjsoul import get_contest_management_servers
 
 class MajsoulClient(MajsoulChannel):
-    def __init__(self, proto, access_token, log_messages=False):
+    # uuids per fetchGameRecordsDetail request
+    _RECORDS_DETAIL_CHUNK_SIZE = 50
+    # requests kept in flight at once by the bulk fetches
+    _MAX_CONCURRENT_FETCHES = 8
+
+    def __init__(self, proto, access_token, log_messages=False, replay_cache=None):
         super().__init__(proto, log_messages)
 
         self._access_token = access_token
+
+        # optional ReplayCache that fetched game logs are kept in
+        self._replay_cache = replay_cache
     
     async def login(self):    
         res = await self.call(
@@ -16,47 +26,345 @@ class MajsoulClient(MajsoulChannel):
             type = 10,
             access_token = self._access_token,
         )
+
+    async def resume(self):
+        await self.login()
+
+    async def close(self):
+        await super().close()
+
+        if self._replay_cache is not None:
+            self._replay_cache.close()
     
     async def fetch_game_log(self, uuid):
+        if self._replay_cache is not None:
+            cached = self._replay_cache.get(uuid)
+
+            if cached is not None:
+                _, _, resClass = self.registry.method('fetchGameRecord')
+                res = resClass()
+                res.ParseFromString(cached)
+                return res
+
         res = await self.call(
             methodName = 'fetchGameRecord',
             game_uuid = uuid
         )
 
+        # Replays only served through data_url are cached by fetch_game_replay once downloaded.
+        if self._replay_cache is not None and res.data:
+            self._replay_cache.put(uuid, res.SerializeToString())
+
         return res
 
+    async def fetch_game_replay(self, uuid):
+        '''
+        Returns: the game's RecordGame head and its replay data, for replay.decode_replay.
+        Older replays are not inlined in the response and get downloaded from data_url.
+        '''
+        res = await self.fetch_game_log(uuid)
+        data = res.data
+
+        if not data and res.data_url:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(res.data_url) as response:
+                    response.raise_for_status()
+                    data = await response.read()
+
+            if self._replay_cache is not None:
+                res.data = data
+                res.data_url = ''
+                self._replay_cache.put(uuid, res.SerializeToString())
+
+        return res.head, data
+
+    async def fetch_game_records(self, uuids, chunk_size=None, limit=None):
+        '''
+        Yields the RecordGame head of each game in uuids. They are requested chunk_size
+        at a time with fetchGameRecordsDetail, up to limit requests in flight at once,
+        and yielded as their chunk arrives rather than in order.
+        '''
+        chunk_size = chunk_size or self._RECORDS_DETAIL_CHUNK_SIZE
+        chunks = [uuids[n:n + chunk_size] for n in range(0, len(uuids), chunk_size)]
+
+        async def fetch(chunk):
+            return await self.call('fetchGameRecordsDetail', uuid_list=chunk)
+
+        # aclosing cancels the requests still in flight as soon as the caller stops early,
+        # rather than whenever the generator gets garbage collected.
+        async with aclosing(bounded_as_completed(fetch, chunks, limit or self._MAX_CONCURRENT_FETCHES)) as results:
+            async for _, res in results:
+                if isinstance(res, Exception):
+                    raise res
+
+                for record in res.record_list:
+                    yield record
+
+    async def fetch_game_replays(self, uuids, limit=None, return_exceptions=False):
+        '''
+        Yields (uuid, head, data) for the replay of each game in uuids as it arrives.
+
+        fetchGameRecordsDetail only returns game heads, so replays are fetched one
+        fetchGameRecord per game, with up to limit requests pipelined on the channel at
+        once. Replays in the replay cache are yielded without a request. A failed fetch
+        raises, or with return_exceptions is yielded as (uuid, exception, None).
+        '''
+        async with aclosing(bounded_as_completed(self.fetch_game_replay, uuids, limit or self._MAX_CONCURRENT_FETCHES)) as results:
+            async for uuid, result in results:
+                if isinstance(result, Exception):
+                    if not return_exceptions:
+                        raise result
+
+                    yield uuid, result, None
+                else:
+                    head, data = result
+                    yield uuid, head, data
+
+SANMA_ROUND_TYPES = [11, 12, 13, 14]
+
+async def bounded_as_completed(func, items, limit):
+    '''
+    Calls the coroutine function func on every item, with at most limit calls running
+    at once, and yields (item, result) pairs as the calls finish. A call that raised
+    yields its exception as the result. Calls still running are cancelled if the
+    caller stops iterating early.
+    '''
+    items = iter(items)
+    running = {}
+
+    def start_next():
+        for item in items:
+            running[asyncio.ensure_future(func(item))] = item
+            return
+
+    try:
+        for _ in range(limit):
+            start_next()
+
+        while running:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                item = running.pop(task)
+                start_next()
+
+                yield item, (task.exception() or task.result())
+    finally:
+        for task in running:
+            task.cancel()
+
+class ContestRules():
+    '''
+    Snapshot of a contest's game rule setting (fetchContestGameRule), with the values
+    score tracking needs derived up front.
+    '''
+    def __init__(self, setting):
+        self.setting = setting
+        self.round_type = setting.round_type
+        self.sanma = setting.round_type in SANMA_ROUND_TYPES
+        self.seats = 3 if self.sanma else 4
+
+        rules = setting.detail_rule_v2.game_rule
+        self.starting_points = rules.init_point
+        self.target_points = rules.fandian
+
+        # First place uma is whatever makes the others sum to zero.
+        if self.sanma:
+            lower = [rules.shunweima_2, rules.shunweima_3]
+        else:
+            lower = [rules.shunweima_2, rules.shunweima_3, rules.shunweima_4]
+        self.uma = [(int)(-1*sum(lower)), *lower]
+
 class ContestManagerClient(MajsoulChannel):
+    _IDEMPOTENT_METHODS = {'startManageGame', 'searchAccountByEid'}
+
+    # Seconds a startManageGame snapshot is reused for. Lobby notifications
+    # invalidate it sooner, this only bounds how stale it can get if one is missed.
+    _LOBBY_MAX_AGE = 30
+    _LOBBY_NOTIFICATIONS = {'NotifyContestMatchingPlayer', 'NotifyContestGameStart', 'NotifyContestGameEnd'}
+
     def __init__(self, proto, access_token, log_messages=False):
         super().__init__(proto, log_messages)
 
         self._access_token = access_token
+        self._contest_id = None
         self._contest_players = []
         self._active_players = []
         self._ongoing_games = []
 
+        self._lobby = None
+        self._lobby_fetched_at = None
+        self._lobby_fetch = None
+        self._lobby_generation = 0
+
+        self._rules = None
+        self._rules_fetch = None
+        self._rules_generation = 0
+
+        # Lookup indexes, kept current from lobby snapshots and game start/end notifications.
+        self._game_by_nickname = {}
+        self._nicknames_by_game = {}
+        self._nickname_by_account = {}
+        self._account_by_nickname = {}
+
     @property
     async def contest_players(self):
         res = await self.call('fetchContestPlayer')
 
         self._contest_players = res.players
 
+        for player in res.players:
+            self.index_player(player.account_id, player.nickname)
+
         return self._contest_players
     
     @property
     async def active_players(self):
-        res = await self.call('startManageGame')
-        
-        self._active_players = res.players
+        await self.lobby()
 
         return self._active_players
 
     @property
     async def ongoing_games(self):
-        res = await self.call('startManageGame')
+        await self.lobby()
+
+        return self._ongoing_games
+
+    async def lobby(self, max_age=None):
+        '''
+        Returns the startManageGame snapshot of queued players and ongoing games.
+
+        The snapshot is reused until a lobby notification invalidates it or it is older than
+        max_age seconds (_LOBBY_MAX_AGE by default). Concurrent callers share one request.
+        The returned message is shared, copy its fields before modifying them.
+        '''
+        if max_age is None:
+            max_age = self._LOBBY_MAX_AGE
+
+        if self._lobby is not None:
+            if asyncio.get_running_loop().time() - self._lobby_fetched_at <= max_age:
+                return self._lobby
+
+        if self._lobby_fetch is None:
+            self._lobby_fetch = asyncio.create_task(self.fetch_lobby())
+
+        # One caller being cancelled shouldn't cancel the request for everyone else.
+        return await asyncio.shield(self._lobby_fetch)
+
+    async def fetch_lobby(self):
+        generation = self._lobby_generation
+
+        try:
+            res = await self.call('startManageGame')
+        finally:
+            if generation == self._lobby_generation:
+                self._lobby_fetch = None
+
+        # Don't cache a snapshot that was invalidated while it was being fetched.
+        if generation == self._lobby_generation:
+            self.update_lobby(res)
+
+        return res
+
+    async def rules(self):
+        '''
+        Returns the ContestRules of the managed contest.
+
+        Fetched once and reused until the rules are changed through this client or another
+        contest is managed. Concurrent callers share one request.
+        '''
+        if self._rules is not None:
+            return self._rules
+
+        if self._rules_fetch is None:
+            self._rules_fetch = asyncio.create_task(self.fetch_rules())
+
+        return await asyncio.shield(self._rules_fetch)
+
+    async def fetch_rules(self):
+        generation = self._rules_generation
+
+        try:
+            res = await self.call('fetchContestGameRule')
+        finally:
+            if generation == self._rules_generation:
+                self._rules_fetch = None
+
+        rules = ContestRules(res.game_rule_setting)
+
+        # Don't cache rules that were invalidated while they were being fetched.
+        if generation == self._rules_generation:
+            self._rules = rules
+
+        return rules
+
+    def invalidate_rules(self):
+        self._rules = None
+        self._rules_fetch = None
+        self._rules_generation += 1
+
+    async def call(self, methodName, **msgFields):
+        try:
+            return await super().call(methodName, **msgFields)
+        finally:
+            if methodName == 'updateContestGameRule':
+                self.invalidate_rules()
+
+    def update_lobby(self, res):
+        self._lobby = res
+        self._lobby_fetched_at = asyncio.get_running_loop().time()
 
         self._ongoing_games = res.games
+        self._active_players = res.players
 
-        return self._ongoing_games
+        # A snapshot lists every ongoing game, so the game index can be rebuilt from it.
+        self._game_by_nickname = {}
+        self._nicknames_by_game = {}
+
+        for game in res.games:
+            self.index_game(game)
+
+        for player in res.players:
+            self.index_player(player.account_id, player.nickname)
+
+    def index_player(self, account_id, nickname):
+        # 0 is AI
+        if account_id > 0 and nickname:
+            self._nickname_by_account[account_id] = nickname
+            self._account_by_nickname[nickname] = account_id
+
+    def index_game(self, game):
+        nicknames = []
+
+        for player in game.players:
+            self.index_player(player.account_id, player.nickname)
+
+            if player.nickname:
+                self._game_by_nickname[player.nickname] = game.game_uuid
+                nicknames.append(player.nickname)
+
+        self._nicknames_by_game[game.game_uuid] = nicknames
+
+    def unindex_game(self, game_uuid):
+        for nickname in self._nicknames_by_game.pop(game_uuid, []):
+            if self._game_by_nickname.get(nickname) == game_uuid:
+                del self._game_by_nickname[nickname]
+
+    def invalidate_lobby(self):
+        self._lobby = None
+        self._lobby_fetch = None
+        self._lobby_generation += 1
+
+    def notified(self, name, msg):
+        if name in self._LOBBY_NOTIFICATIONS:
+            self.invalidate_lobby()
+
+        if name == 'NotifyContestGameStart':
+            self.index_game(msg.game_info)
+        elif name == 'NotifyContestGameEnd':
+            self.unindex_game(msg.game_uuid)
+        elif name == 'NotifyContestMatchingPlayer':
+            self.index_player(msg.account_id, msg.nickname)
 
     async def login(self):    
         res = await self.call(
@@ -65,6 +373,34 @@ class ContestManagerClient(MajsoulChannel):
             access_token = self._access_token,
             reconnect = True
         )
+
+    async def manage_contest(self, contest_id):
+        res = await self.call('manageContest', unique_id=contest_id)
+
+        self._contest_id = contest_id
+        self.invalidate_rules()
+
+        # Games and queued players belong to the previous contest until the next snapshot.
+        self.invalidate_lobby()
+        self._ongoing_games = []
+        self._active_players = []
+        self._game_by_nickname = {}
+        self._nicknames_by_game = {}
+
+        return res.contest
+
+    async def resume(self):
+        '''
+        Logs back in and re-enters the managed contest after a reconnect, so lobby
+        notifications start flowing again.
+        '''
+        await self.login()
+
+        if self._contest_id is not None:
+            await self.manage_contest(self._contest_id)
+
+            self.invalidate_lobby()
+            self.update_lobby(await self.call('startManageGame'))
     
     async def get_game_id(self, nickname):
         '''
@@ -72,12 +408,10 @@ class ContestManagerClient(MajsoulChannel):
         return the game id
         '''
 
-        res = await self.call('startManageGame')
-        
-        for game in res.games:
-            for player in game.players:
-                if player.nickname == nickname:
-                    return game.game_uuid
+        if nickname not in self._game_by_nickname:
+            await self.lobby()
+
+        return self._game_by_nickname.get(nickname)
 
     async def pause(self, game_uuid):
         res = await self.call('pauseGame', uuid=game_uuid)
@@ -87,32 +421,49 @@ class ContestManagerClient(MajsoulChannel):
 
     async def terminate(self, game_uuid):
         res = await self.call('terminateGame', serviceName='CustomizedContestManagerApi', uuid=game_uuid)
+
+        self.invalidate_lobby()
     
     async def display_players(self, res=None):
         if res == None:
-            res = await self.call('startManageGame')
-
-        self._ongoing_games = res.games
-        self._active_players = res.players
+            res = await self.lobby()
+        else:
+            self.update_lobby(res)
 
         return (res.games, res.players)
 
     async def get_player_nickname(self, playerID):
-        res = await self.call('fetchContestPlayer')
+        if playerID not in self._nickname_by_account:
+            await self.contest_players
 
-        for player in res.players:
-            if player.account_id == playerID:
-                return player.nickname
-        
-        return None
+        return self._nickname_by_account.get(playerID)
+
+    async def get_account_id(self, nickname):
+        if nickname not in self._account_by_nickname:
+            await self.contest_players
+
+        return self._account_by_nickname.get(nickname)
     
     async def create_game(self, playerIDs):
-        playerList = []
-        for pid in playerIDs:
-            playerList.append(self.proto.ReqCreateContestGame.Slot(account_id=pid))
-            # 0 is AI
-            if pid > 0:
-                await self.call('lockGamePlayer', account_id=pid)
+        playerList = [self.proto.ReqCreateContestGame.Slot(account_id=pid) for pid in playerIDs]
+
+        # 0 is AI
+        humanIDs = [pid for pid in playerIDs if pid > 0]
+
+        # Lock everyone at once rather than one round trip after another.
+        results = await asyncio.gather(
+            *[self.call('lockGamePlayer', account_id=pid) for pid in humanIDs],
+            return_exceptions=True)
+
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            # Don't leave the rest of the table stuck in a game that won't be created.
+            locked = [pid for pid, r in zip(humanIDs, results) if not isinstance(r, Exception)]
+            await asyncio.gather(
+                *[self.call('unlockGamePlayer', account_id=pid) for pid in locked],
+                return_exceptions=True)
+            raise errors[0]
+
         res = await self.call(
             methodName='createContestGame',
             slots = playerList,
@@ -120,12 +471,15 @@ class ContestManagerClient(MajsoulChannel):
             open_live=True,
             ai_level=2
         )
+
+        self.invalidate_lobby()
+
         return res.game_uuid
     
     async def create_random_games(self):
-        res = await self.call('startManageGame')
+        res = await self.lobby()
 
-        players = res.players
+        players = list(res.players)
 
         i = 0
         table = []
@@ -0,0 +1,167 @@
+'''
+Lazy decoding of game replays.
+
+ResGameRecord.data is a Wrapper around GameDetailRecords, whose records are in turn
+Wrappers around one Record* message each (RecordNewRound, RecordDiscardTile, ...).
+Parsing GameDetailRecords would materialize every record of the replay at once, so
+instead the protobuf wire format is walked directly and each record is only parsed
+when the generator gets to it.
+'''
+from collections import namedtuple
+
+from google.protobuf.message import DecodeError
+
+from .channel import ProtoRegistry
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LEN = 2
+WIRE_FIXED32 = 5
+
+# round is the index of the hand the record belongs to, counting RecordNewRound from 0.
+# name is the Record* message name and msg the parsed message.
+ReplayEvent = namedtuple('ReplayEvent', ['round', 'name', 'msg'])
+
+class ReplayDecodeError(Exception):
+    def __init__(self, reason):
+        self.message = f"Malformed replay data: {reason}"
+        super().__init__(self.message)
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+
+    while True:
+        if pos >= len(buf):
+            raise ReplayDecodeError('truncated varint')
+
+        byte = buf[pos]
+        pos += 1
+
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+
+        shift += 7
+        if shift >= 64:
+            raise ReplayDecodeError('varint too long')
+
+def iter_fields(buf):
+    '''
+    Yields (field number, wire type, value) for each field of a serialized message.
+    Length-delimited values are memoryview slices of buf rather than copies.
+    '''
+    buf = memoryview(buf)
+    pos = 0
+
+    while pos < len(buf):
+        key, pos = read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x7
+
+        if wire_type == WIRE_VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == WIRE_LEN:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == WIRE_FIXED64:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == WIRE_FIXED32:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ReplayDecodeError(f'unsupported wire type {wire_type}')
+
+        if pos > len(buf):
+            raise ReplayDecodeError(f'field {field} runs past the end of the message')
+
+        yield field, wire_type, value
+
+def unwrap(buf):
+    '''
+    Returns: (name, data) of a serialized Wrapper, without the package prefix in name.
+    data is a view into buf.
+    '''
+    name = ''
+    data = memoryview(b'')
+
+    for field, wire_type, value in iter_fields(buf):
+        if field == 1 and wire_type == WIRE_LEN:
+            name = bytes(value).decode()
+        elif field == 2 and wire_type == WIRE_LEN:
+            data = value
+
+    return name.rsplit('.', 1)[-1], data
+
+def iter_records(data):
+    '''
+    Yields each record of a replay (ResGameRecord.data) as a serialized Wrapper.
+
+    Older replays list the records in GameDetailRecords.records (field 1). Newer ones
+    leave that empty and carry each record as the result (field 3) of a GameAction in
+    GameDetailRecords.actions (field 3), which the bundled proto doesn't define yet.
+    '''
+    name, details = unwrap(data)
+
+    if name != 'GameDetailRecords':
+        raise ReplayDecodeError(f'expected GameDetailRecords, got {name!r}')
+
+    found = False
+    unknown = set()
+
+    for field, wire_type, value in iter_fields(details):
+        if field == 1 and wire_type == WIRE_LEN:
+            found = True
+            yield value
+        elif field == 3 and wire_type == WIRE_LEN:
+            found = True
+            for action_field, action_wire_type, action_value in iter_fields(value):
+                # Actions without a result are player inputs.
+                if action_field == 3 and action_wire_type == WIRE_LEN and len(action_value):
+                    yield action_value
+        elif field != 2:
+            # field 2 is the format version
+            unknown.add(field)
+
+    # Rather than an empty replay, which would silently count as a game without hands.
+    if not found and unknown:
+        raise ReplayDecodeError(f'no records in a layout that is understood, only fields {sorted(unknown)}')
+
+def decode_replay(data, proto, names=None):
+    '''
+    Yields a ReplayEvent for each record of a replay (ResGameRecord.data), parsing one
+    record at a time.
+
+    Params:
+        data : bytes
+            Replay data, see MajsoulClient.fetch_game_replay
+
+        proto : module
+            Protobuf module defining the Record* messages, e.g. lq_dhs_pb2
+
+        names : set
+            (optional) Record* names to yield. Other records are skipped without being
+            parsed, but still count towards the round index.
+    '''
+    registry = ProtoRegistry.get(proto)
+    round_index = -1
+
+    for record in iter_records(data):
+        name, payload = unwrap(record)
+
+        if name == 'RecordNewRound':
+            round_index += 1
+
+        if names is not None and name not in names:
+            continue
+
+        try:
+            msg = registry.message(name)()
+            msg.ParseFromString(bytes(payload))
+        except KeyError:
+            raise ReplayDecodeError(f'unknown record {name!r}')
+        except DecodeError as e:
+            raise ReplayDecodeError(f'{name} could not be parsed: {e}')
+
+        yield ReplayEvent(round_index, name, msg)
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import time
+import zlib
+
+INDEX_FILENAME = 'index.json'
+COMPRESSION_LEVEL = 6
+
+# Changes written before the index is saved again. Replays added since the last save are
+# left out of it if the process dies, and their files removed on the next start.
+INDEX_SAVE_INTERVAL = 64
+
+class ReplayCache():
+    '''
+    Compressed on-disk cache of game replays, keyed by game uuid.
+
+    A replay never changes once its game ended, so entries are never invalidated, only
+    evicted least recently used first once the files add up to more than max_bytes.
+    Each replay is a zlib compressed file named after the hash of its uuid, and an
+    index file keeps track of their sizes and when they were last used. The index is
+    saved every INDEX_SAVE_INTERVAL changes and on close().
+    '''
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        os.makedirs(path, exist_ok=True)
+
+        # uuid -> [compressed size, last access time]
+        self.entries = {}
+        self.total_bytes = 0
+        self.dirty = False
+        self.unsaved_changes = 0
+
+        self.load_index()
+
+    def __contains__(self, uuid):
+        return uuid in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def filename(self, uuid):
+        return os.path.join(self.path, f'{hashlib.sha1(uuid.encode()).hexdigest()}.z')
+
+    def load_index(self):
+        try:
+            with open(os.path.join(self.path, INDEX_FILENAME), 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            entries = {}
+        except ValueError:
+            print(f'Replay cache index in {self.path} is corrupt, starting over')
+            entries = {}
+
+            for name in os.listdir(self.path):
+                if name.endswith('.z'):
+                    os.remove(os.path.join(self.path, name))
+
+        # Files can go missing if the process died between removing one and saving the index.
+        self.entries = {uuid: entry for uuid, entry in entries.items() if os.path.exists(self.filename(uuid))}
+        self.total_bytes = sum(size for size, _ in self.entries.values())
+
+        # Files written since the index was last saved aren't counted towards max_bytes.
+        indexed = {os.path.basename(self.filename(uuid)) for uuid in self.entries}
+        for name in os.listdir(self.path):
+            if name.endswith('.z') and name not in indexed:
+                os.remove(os.path.join(self.path, name))
+
+    def save_index(self):
+        index_path = os.path.join(self.path, INDEX_FILENAME)
+
+        with open(f'{index_path}.tmp', 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(f'{index_path}.tmp', index_path)
+
+        self.dirty = False
+        self.unsaved_changes = 0
+
+    def changed(self):
+        self.dirty = True
+        self.unsaved_changes += 1
+
+        if self.unsaved_changes >= INDEX_SAVE_INTERVAL:
+            self.save_index()
+
+    def get(self, uuid):
+        '''
+        Returns: the cached replay bytes, or None
+        '''
+        if uuid not in self.entries:
+            return None
+
+        try:
+            with open(self.filename(uuid), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except (OSError, zlib.error):
+            self.remove(uuid)
+            self.changed()
+            return None
+
+        # Saved along with the next change rather than on every hit.
+        self.entries[uuid][1] = time.time()
+        self.dirty = True
+
+        return data
+
+    def put(self, uuid, data):
+        blob = zlib.compress(data, COMPRESSION_LEVEL)
+        filename = self.filename(uuid)
+
+        with open(f'{filename}.tmp', 'wb') as f:
+            f.write(blob)
+        os.replace(f'{filename}.tmp', filename)
+
+        if uuid in self.entries:
+            self.total_bytes -= self.entries[uuid][0]
+
+        self.entries[uuid] = [len(blob), time.time()]
+        self.total_bytes += len(blob)
+
+        self.evict()
+        self.changed()
+
+    def remove(self, uuid):
+        size, _ = self.entries.pop(uuid)
+        self.total_bytes -= size
+
+        try:
+            os.remove(self.filename(uuid))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        '''
+        Removes the least recently used replays until the cache fits in max_bytes.
+        '''
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        for uuid, _ in sorted(self.entries.items(), key=lambda entry: entry[1][1]):
+            if self.total_bytes <= self.max_bytes:
+                break
+
+            self.remove(uuid)
+
+    def close(self):
+        if self.dirty:
+            self.save_index()
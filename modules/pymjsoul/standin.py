@@ -0,0 +1,303 @@
+'''
+Local stand-in for the Majsoul websocket servers.
+
+Speaks the same framing as MajsoulChannel (see MajsoulChannel.send): a 1 byte message
+type, a 2 byte little endian message index on requests and responses, and a Wrapper
+around the protobuf payload. Responses are scripted per method, or replayed from a
+session captured with SessionRecorder, so channels, clients and cogs can be exercised
+and benchmarked without the live servers.
+'''
+import asyncio
+import base64
+import inspect
+import json
+import time
+from collections import Counter, defaultdict, deque
+
+import websockets
+
+from .channel import ProtoRegistry, MSG_TYPE_NOTIFY, MSG_TYPE_REQUEST, MSG_TYPE_RESPONSE
+
+# Error code sent back for methods that have no scripted or recorded response.
+ERR_METHOD_NOT_FOUND = 6
+
+class SessionRecorder():
+    '''
+    Captures every frame a channel sends and receives, to be served again by SessionReplay.
+
+    Set it as channel.recorder before connecting. Each line of the capture file is a JSON
+    object with the frame's direction ('sent' or 'received'), its time in seconds since
+    the first frame, and the frame itself in base64.
+    '''
+    def __init__(self, path):
+        # A capture holds one session, timed from its first frame.
+        self.file = open(path, 'w')
+        self.started = None
+
+    def record(self, direction, frame):
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+
+        json.dump({
+            'direction': direction,
+            'time': now - self.started,
+            'frame': base64.b64encode(frame).decode(),
+        }, self.file)
+        self.file.write('\n')
+
+    def close(self):
+        self.file.close()
+
+class StandinServer():
+    '''
+    Websocket server answering requests with scripted responses.
+
+    Params:
+        proto : module
+            Protobuf module defining the methods and messages, e.g. lq_dhs_pb2
+
+        responses : dict
+            (optional) Method name (without package or service) -> response. A response is
+            either a response message, a list of them served in order with the last one
+            repeated, or a function taking the parsed request and returning the response
+            message (it may be a coroutine function). Methods without a response get
+            ERR_METHOD_NOT_FOUND.
+
+        latency : float
+            (optional) Seconds every response is held back for.
+
+    Example Usage:
+        async with StandinServer(lq, {'oauth2Login': lq.ResLogin()}) as server:
+            await client.connect(server.uri)
+            await server.notify('NotifyContestGameEnd', game_uuid='...')
+    '''
+    def __init__(self, proto, responses=None, latency=0):
+        self.proto = proto
+        self.registry = ProtoRegistry.get(proto)
+        # Lists are copied, serving a response takes it off the list.
+        self.responses = {methodName: list(response) if isinstance(response, list) else response
+                          for methodName, response in (responses or {}).items()}
+        self.latency = latency
+
+        self.server = None
+        self.uri = None
+        self.connections = set()
+
+        # method name -> requests received
+        self.requests = Counter()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def start(self, host='127.0.0.1', port=0):
+        '''
+        Starts listening, on a free port unless one is given.
+
+        Returns: uri to connect to
+        '''
+        self.server = await websockets.serve(self.serve, host, port)
+
+        port = self.server.sockets[0].getsockname()[1]
+        self.uri = f'ws://{host}:{port}'
+
+        return self.uri
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve(self, websocket):
+        '''
+        Handles one connection. Requests are answered concurrently, so pipelined requests
+        can get their responses out of order like they do from the real servers.
+        '''
+        self.connections.add(websocket)
+        responders = set()
+
+        try:
+            async for frame in websocket:
+                if frame[0] != MSG_TYPE_REQUEST:
+                    continue
+
+                responder = asyncio.create_task(self.respond(websocket, frame))
+                responders.add(responder)
+                responder.add_done_callback(responders.discard)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.connections.discard(websocket)
+
+            for responder in responders:
+                responder.cancel()
+
+    async def respond(self, websocket, frame):
+        msgIndex = frame[1:3]
+
+        wrapper = self.proto.Wrapper()
+        wrapper.ParseFromString(frame[3:])
+
+        # e.g. '.lq.Lobby.fetchGameRecord'
+        _, serviceName, methodName = wrapper.name.rsplit('.', 2)
+        self.requests[methodName] += 1
+
+        payload, delay = await self.response(serviceName, methodName, wrapper.data)
+
+        if delay:
+            await asyncio.sleep(delay)
+
+        try:
+            await websocket.send(MSG_TYPE_RESPONSE.to_bytes(1, 'little') + msgIndex + payload)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def response(self, serviceName, methodName, data):
+        '''
+        Returns: (wrapped response payload, seconds to hold it back for)
+        '''
+        _, reqMessageClass, resMessageClass = self.registry.method(methodName, serviceName)
+        response = self.responses.get(methodName)
+
+        if isinstance(response, list):
+            response = response.pop(0) if len(response) > 1 else response[0]
+        elif callable(response):
+            request = reqMessageClass()
+            request.ParseFromString(data)
+
+            response = response(request)
+            if inspect.isawaitable(response):
+                response = await response
+
+        if response is None:
+            response = resMessageClass()
+            response.error.code = ERR_METHOD_NOT_FOUND
+
+        return self.wrap('', response.SerializeToString()), self.latency
+
+    async def notify(self, name, msg=None, **msgFields):
+        '''
+        Sends a notification to every connected client.
+
+        Param:
+            name : str
+                Name of the notification message (without package name). Example: 'NotifyContestGameEnd'
+
+            msg : protobuf message (optional)
+                Notification to send, otherwise one is built from msgFields.
+
+        Returns: number of clients it was sent to
+        '''
+        if msg is None:
+            msg = self.registry.message(name)(**msgFields)
+
+        frame = MSG_TYPE_NOTIFY.to_bytes(1, 'little') + self.wrap(f'.{self.proto.DESCRIPTOR.package}.{name}', msg.SerializeToString())
+
+        return await self.broadcast(frame)
+
+    async def broadcast(self, frame):
+        connections = list(self.connections)
+
+        for websocket in connections:
+            try:
+                await websocket.send(frame)
+            except websockets.ConnectionClosed:
+                pass
+
+        return len(connections)
+
+    def wrap(self, name, data):
+        return self.proto.Wrapper(name=name, data=data).SerializeToString()
+
+class SessionReplay(StandinServer):
+    '''
+    Stand-in server that plays back a session captured with SessionRecorder.
+
+    Requests are answered with the response recorded for the same method and request
+    payload, or failing that for the same method, in the order they were recorded, and
+    held back for the recorded round trip time. Recorded notifications are sent to every
+    client on its own schedule from when it connects. All recorded delays are divided by
+    speed, speed=float('inf') plays everything back as fast as possible.
+
+    Scripted responses can be given as well, they are used once the recorded ones for a
+    method run out.
+    '''
+    def __init__(self, proto, path, speed=1, responses=None):
+        super().__init__(proto, responses)
+        self.speed = speed
+
+        # (method name, request payload) -> recorded (wrapped response, round trip time)
+        self.recorded = defaultdict(deque)
+        # method name -> the same responses, for requests that don't match one exactly
+        self.recorded_by_method = defaultdict(deque)
+        # (time, raw notify frame)
+        self.notifications = []
+
+        self.load(path)
+
+    def load(self, path):
+        # msgIndex -> (method name, request payload, time sent), until its response is seen
+        sent = {}
+
+        with open(path, 'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                frame = base64.b64decode(entry['frame'])
+                msgType = frame[0]
+
+                if entry['direction'] == 'sent' and msgType == MSG_TYPE_REQUEST:
+                    wrapper = self.proto.Wrapper()
+                    wrapper.ParseFromString(frame[3:])
+
+                    methodName = wrapper.name.rsplit('.', 1)[-1]
+                    sent[frame[1:3]] = (methodName, wrapper.data, entry['time'])
+                elif entry['direction'] == 'received' and msgType == MSG_TYPE_RESPONSE:
+                    if frame[1:3] not in sent:
+                        continue
+
+                    methodName, data, sentAt = sent.pop(frame[1:3])
+                    response = [frame[3:], entry['time'] - sentAt]
+
+                    # Shared between both lookups, served at most once.
+                    self.recorded[(methodName, data)].append(response)
+                    self.recorded_by_method[methodName].append(response)
+                elif entry['direction'] == 'received' and msgType == MSG_TYPE_NOTIFY:
+                    self.notifications.append((entry['time'], frame))
+
+    async def serve(self, websocket):
+        player = asyncio.create_task(self.play_notifications(websocket))
+
+        try:
+            await super().serve(websocket)
+        finally:
+            player.cancel()
+
+    async def play_notifications(self, websocket):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        for at, frame in self.notifications:
+            delay = started + at / self.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            await websocket.send(frame)
+
+    async def response(self, serviceName, methodName, data):
+        for responses in (self.recorded[(methodName, data)], self.recorded_by_method[methodName]):
+            while responses:
+                response = responses.popleft()
+
+                # Already served through the other lookup.
+                if response[0] is None:
+                    continue
+
+                payload, roundTrip = response
+                response[0] = None
+
+                return payload, roundTrip / self.speed
+
+        return await super().response(serviceName, methodName, data)